@@ -3,9 +3,11 @@
 import os
 import pwd
 import sys
+import yaml
 from bob.common import db
 from bob.common import queues
-from bob.common.task import Task
+from bob.common.task import Task, State, Priority
+from bob.common.submit import submit_task
 from subprocess import check_output
 
 
@@ -61,17 +63,17 @@ def _print_task(task, format_str):
                             duration=task.get_duration()))
 
 
-def cmd_list(repo, branch, tag):
+def cmd_list(repo, branch, tag, limit=None):
     format_str = '{state} - {repo} - {branch} - {tag} - {build_args} - {duration} - {builder_info} - {created_by}'
     print(format_str)
-    for task in db.tasks_list(git_repo=repo, git_branch=branch, git_tag=tag):
+    for task in db.tasks_list(git_repo=repo, git_branch=branch, git_tag=tag, limit=limit):
         _print_task(task, format_str)
 
 
-def cmd_ps(repo, branch, tag):
+def cmd_ps(repo, branch, tag, limit=None):
     format_str = '{state} - {repo} - {branch} - {tag} - {build_args} - {duration} - {builder_info} - {created_by}'
     print(format_str)
-    for task in db.tasks_ps(git_repo=repo, git_branch=branch, git_tag=tag):
+    for task in db.tasks_ps(git_repo=repo, git_branch=branch, git_tag=tag, limit=limit):
         _print_task(task, format_str)
 
 
@@ -82,7 +84,23 @@ def _get_username():
         return 'cli'
 
 
-def _build(repo, branch='master', tag=None, args=[]):
+def _get_priority(priority, repo_from_cwd):
+    """
+    returns the --priority given, else the priority in the current directory's bob-the-builder.yml
+    """
+    if priority:
+        return priority
+
+    if not repo_from_cwd or not os.path.isfile('bob-the-builder.yml'):
+        return None
+    try:
+        with open('bob-the-builder.yml', 'r') as f:
+            return (yaml.safe_load(f) or {}).get('priority')
+    except Exception:
+        return None
+
+
+def _build(repo, branch='master', tag=None, args=[], cancel_running=False, priority=None):
     if not repo:
         print('failed: are you in a git repo?')
         return
@@ -91,10 +109,10 @@ def _build(repo, branch='master', tag=None, args=[]):
                 git_branch=branch,
                 git_tag=tag,
                 build_args=args,
-                created_by=_get_username())
+                created_by=_get_username(),
+                priority=priority)
 
-    db.save_task(task)
-    queues.enqueue_task(task)
+    superseded = submit_task(task, cancel_running=cancel_running)
 
     msg = 'ok - building: ' + repo
     if branch:
@@ -102,6 +120,34 @@ def _build(repo, branch='master', tag=None, args=[]):
     if tag:
         msg += ' - ' + tag
     print(msg)
+    for old_task in superseded:
+        print('superseded: {0} - {1} - {2} - {3}'.format(
+            old_task.git_repo, old_task.git_branch, old_task.git_tag, old_task.created_at.isoformat()))
+
+
+def _resume(repo, branch='master', tag=None):
+    """
+    re-queues the newest failed or canceled task of the repo, branch and tag,
+    the worker picks it up after the last stage it finished.
+    """
+    if not repo:
+        print('failed: are you in a git repo?')
+        return
+
+    tasks = list(db.list_tasks(git_repo=repo, git_branch=branch, git_tag=tag, limit=1))
+    if not tasks:
+        print('failed: no task to resume')
+        return
+
+    task = tasks[0]
+    if not task.can_resume():
+        print('failed: the newest task is {0}, only a failed or canceled task can be resumed'.format(task.state))
+        return
+
+    task.set_state(State.pending, 'resumed after {0} by {1}'.format(task.checkpoint['stage'], _get_username()))
+    db.save_task_state(task)
+    queues.enqueue_task(task)
+    print('ok - resuming: {0} - {1} - {2} after {3}'.format(repo, branch, task.git_tag, task.checkpoint['stage']))
 
 
 def print_build_help():
@@ -113,13 +159,26 @@ Options:
     --force-rm  Always remove intermediate containers.
     --no-cache  Do not use cache when building the image.
     --pull      Always attempt to pull a newer version of the image.
+    --priority  high, normal or low, the default is bob-the-builder.yml's priority, else low.
+    --cancel-running  Also cancel the running builds of the same branch and tag, pending ones always are.
+
+Usage: resume [options]
+    Re-queues the newest failed or canceled build, which continues after the last stage it finished.
+Options:
+    --repo      Git Repo, will find from current directory otherwise.
+    --branch    Git Branch, will find from current directory otherwise.
+    --tag       Git Tag.
+
+Usage: ps|ls [options]
+Options:
+    --limit     Only show the newest N tasks.
 """)
 
 
 def main():
 
     if len(sys.argv) < 2:
-        print ('commands are: build, ps, ls, cancel')
+        print ('commands are: build, resume, ps, ls, cancel')
         sys.exit(1)
 
     program = sys.argv.pop(0)
@@ -128,6 +187,9 @@ def main():
     repo = None
     branch = None
     tag = None
+    limit = None
+    cancel_running = False
+    priority = None
     args = []
     while len(sys.argv):
         arg = sys.argv.pop(0)
@@ -140,9 +202,20 @@ def main():
             branch = sys.argv.pop(0)
         elif arg == '--tag':
             tag = sys.argv.pop(0)
+        elif arg == '--limit':
+            limit = int(sys.argv.pop(0))
+        elif arg == '--cancel-running':
+            cancel_running = True
+        elif arg == '--priority':
+            priority = sys.argv.pop(0)
         else:
             args.append(arg)
 
+    if priority and priority not in Priority.all:
+        print('failed: --priority must be one of: {0}'.format(', '.join(Priority.all)))
+        return
+
+    repo_from_cwd = not repo
     if not repo:
         repo = _get_repo()
 
@@ -150,11 +223,18 @@ def main():
         branch = _get_branch('master')
 
     if cmd == 'build':
-        _build(repo=repo, branch=branch, tag=tag, args=args)
+        _build(repo=repo,
+               branch=branch,
+               tag=tag,
+               args=args,
+               cancel_running=cancel_running,
+               priority=_get_priority(priority, repo_from_cwd))
+    elif cmd == 'resume':
+        _resume(repo=repo, branch=branch, tag=tag)
     elif cmd == 'ps':
-        cmd_ps(repo=repo, branch=branch, tag=tag)
+        cmd_ps(repo=repo, branch=branch, tag=tag, limit=limit)
     elif cmd == 'ls':
-        cmd_list(repo=repo, branch=branch, tag=tag)
+        cmd_list(repo=repo, branch=branch, tag=tag, limit=limit)
     elif cmd == 'cancel':
         print('cancel')
 
@@ -1,10 +1,47 @@
 import os
+import threading
 import yaml
 from bob.common.settings import find_settings_file
 import boto3
+from botocore.config import Config
 
+_default_max_pool_connections = 25
 
-def _load_settings():
+
+class _Registry(threading.local):
+    """
+    the boto3 session and clients are created once per process the first time they are used.
+    boto3 resources are not thread safe, so they are kept per thread.
+    """
+    pid = None
+    resources = None
+
+
+_lock = threading.Lock()
+_pid = None
+_session = None
+_config = None
+_clients = {}
+_thread_registry = _Registry()
+
+
+def _reset_after_fork():
+    """
+    a forked child must not share the parent's connections, or a lock a parent thread held.
+    """
+    global _lock, _pid, _session, _config, _clients
+    _lock = threading.Lock()
+    _pid = os.getpid()
+    _session = None
+    _config = None
+    _clients = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def load_settings():
     file_path = find_settings_file('aws-settings.yml')
     if not os.path.isfile(file_path):
         return None
@@ -12,8 +49,14 @@ def _load_settings():
         return yaml.safe_load(f)
 
 
-def get_boto3_session():
-    settings = _load_settings()
+def _get_config(settings):
+    max_pool_connections = _default_max_pool_connections
+    if settings and 'max_pool_connections' in settings:
+        max_pool_connections = int(settings['max_pool_connections'])
+    return Config(max_pool_connections=max_pool_connections)
+
+
+def _create_boto3_session(settings):
     if not settings:
         return boto3.session.Session(profile_name='default')
     return boto3.session.Session(aws_access_key_id=settings['aws_access_key_id'],
@@ -21,5 +64,53 @@ def get_boto3_session():
                                  region_name=settings['region_name'])
 
 
+def _check_pid():
+    # covers fork() without register_at_fork() e.g. python < 3.7
+    if _pid != os.getpid():
+        _reset_after_fork()
+
+
+def get_boto3_session():
+    """
+    returns this process's boto3 session, the settings are read on first use.
+    """
+    global _session, _config
+    _check_pid()
+    with _lock:
+        if _session is None:
+            settings = load_settings()
+            _session = _create_boto3_session(settings)
+            _config = _get_config(settings)
+        return _session
+
+
+def get_boto3_client(service_name):
+    """
+    returns this process's pooled boto3 client, clients are thread safe.
+    """
+    _check_pid()
+    with _lock:
+        client = _clients.get(service_name)
+    if client is None:
+        client = get_boto3_session().client(service_name, config=_config)
+        with _lock:
+            client = _clients.setdefault(service_name, client)
+    return client
+
+
 def get_boto3_resource(resource_name):
-    return get_boto3_session().resource(resource_name)
+    """
+    returns this thread's boto3 resource, created once per thread with a pooled connection.
+    """
+    _check_pid()
+    if _thread_registry.pid != os.getpid():
+        _thread_registry.pid = os.getpid()
+        _thread_registry.resources = {}
+
+    resource = _thread_registry.resources.get(resource_name)
+    if resource is None:
+        session = get_boto3_session()
+        with _lock:
+            resource = session.resource(resource_name, config=_config)
+        _thread_registry.resources[resource_name] = resource
+    return resource
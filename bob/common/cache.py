@@ -0,0 +1,186 @@
+import json
+import threading
+from collections import OrderedDict
+from time import time
+
+from bob.common.aws import load_settings
+from bob.common.tools import to_json_value
+
+_default_active_ttl = 2
+_default_done_ttl = 60 * 60
+_default_max_entries = 1000
+# how long after a write the task is only cached for active_ttl, longer than any read that raced the write.
+_default_invalidated_ttl = 30
+
+
+class LocalCache(object):
+    """
+    a least recently used cache in this process's memory.
+    """
+
+    # other processes' writes cannot delete its entries.
+    shared = False
+
+    def __init__(self, max_entries=_default_max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time():
+                del self.entries[key]
+                return None
+            # keep it from being the next evicted.
+            del self.entries[key]
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time() + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        """
+        sets the key only if it is not already set, returns True if it was set.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] >= time():
+                return False
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time() + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RedisCache(object):
+    """
+    a cache shared by every process that uses the same redis server, e.g. all the web server workers.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix='bob:'):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.redis.setex(self.prefix + key, max(1, int(ttl)), value)
+
+    def add(self, key, value, ttl):
+        """
+        sets the key only if it is not already set, returns True if it was set.
+        """
+        return bool(self.redis.set(self.prefix + key, value, ex=max(1, int(ttl)), nx=True))
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+
+class TaskCache(object):
+    """
+    a read-through cache of tasks: an in progress task is kept for active_ttl seconds. a finished one is kept
+    for done_ttl seconds in a shared backend, which every write deletes it from, e.g. when it is resumed.
+    a process's own cache never sees the other processes' writes, so it keeps every task for active_ttl.
+
+    a reader can cache a task it read just before a write deleted it, so for invalidated_ttl seconds after a
+    delete the task is only cached for active_ttl, e.g. a failed task that was just resumed is not kept as failed.
+    """
+
+    def __init__(self, backend, active_ttl=_default_active_ttl, done_ttl=_default_done_ttl,
+                 invalidated_ttl=_default_invalidated_ttl):
+        self.backend = backend
+        self.active_ttl = active_ttl
+        self.done_ttl = done_ttl
+        self.invalidated_ttl = invalidated_ttl
+
+    def get(self, key):
+        """
+        returns the cached task dictionary, None if it is not cached.
+        """
+        try:
+            value = self.backend.get(key)
+        except Exception as ex:
+            print('task cache read failed: {0}'.format(ex))
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, task):
+        try:
+            ttl = self.active_ttl
+            if task.is_done() and self.backend.shared and self.backend.get('invalidated:' + key) is None:
+                ttl = self.done_ttl
+            self.backend.set(key, json.dumps(to_json_value(task.to_dict())), ttl)
+        except Exception as ex:
+            print('task cache write failed: {0}'.format(ex))
+
+    def delete(self, key):
+        try:
+            self.backend.set('invalidated:' + key, '1', self.invalidated_ttl)
+            self.backend.delete(key)
+        except Exception as ex:
+            print('task cache delete failed: {0}'.format(ex))
+
+
+_task_cache = None
+_task_cache_lock = threading.Lock()
+
+
+def _get_cache_settings():
+    return (load_settings() or {}).get('task_cache') or {}
+
+
+def create_cache(max_entries=None):
+    """
+    returns the redis cache set by 'task_cache: redis_url' in aws-settings.yml,
+    otherwise a cache of up to max_entries in this process.
+    """
+    settings = _get_cache_settings()
+    if settings.get('redis_url'):
+        try:
+            return RedisCache(settings['redis_url'])
+        except ImportError:
+            print('the redis package is not installed, caching in this process')
+    return LocalCache(int(max_entries or settings.get('max_entries', _default_max_entries)))
+
+
+def _create_task_cache():
+    settings = _get_cache_settings()
+    return TaskCache(create_cache(),
+                     active_ttl=float(settings.get('active_ttl', _default_active_ttl)),
+                     done_ttl=float(settings.get('done_ttl', _default_done_ttl)),
+                     invalidated_ttl=float(settings.get('invalidated_ttl', _default_invalidated_ttl)))
+
+
+def get_task_cache():
+    """
+    returns the task cache configured under 'task_cache' in aws-settings.yml e.g.
+        task_cache:
+          redis_url: redis://localhost:6379/0
+          active_ttl: 2
+          done_ttl: 3600
+    without a redis_url each process keeps its own cache of up to max_entries tasks, each for active_ttl.
+    """
+    global _task_cache
+    with _task_cache_lock:
+        if _task_cache is None:
+            _task_cache = _create_task_cache()
+        return _task_cache
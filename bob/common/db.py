@@ -1,34 +1,151 @@
+import base64
+import heapq
+import json
 from datetime import datetime
 
 from boto3.dynamodb.conditions import Attr, Key
-from bob.common.aws import get_boto3_resource, get_boto3_session
+from botocore.exceptions import ClientError
+from bob.common.aws import get_boto3_resource, get_boto3_client
+from bob.common.cache import get_task_cache
 
+from bob.common.exceptions import BobTaskConflictError
 from bob.common.task import Task, State
 from bob.worker.aws_helpers import error_code_equals
 
 _task_table_name = 'bob-task'
 #_task_table_name = 'bob-task-test'
 
+_build_cache_table_name = 'bob-build-cache'
 
-def _table_exists(table_name):
-    client = get_boto3_session().client('dynamodb')
+# every task is written with the same 'list_partition' value so the
+# created_at index can return the whole table newest first with a query.
+_created_at_index_name = 'created_at-index'
+_task_list_partition = 'task'
+
+# 'bob ps' queries this index once per active state instead of scanning the table.
+_state_index_name = 'state-created_at-index'
+
+# the dashboard asks this index for the tasks changed since it last looked.
+_modified_at_index_name = 'modified_at-index'
+
+# what a task list shows, a list never reads the logs, events or checkpoints.
+summary_fields = ('git_repo',
+                  'git_branch',
+                  'git_tag',
+                  'state',
+                  'state_message',
+                  'created_at',
+                  'modified_at',
+                  'started_at',
+                  'finished_at',
+                  'created_by',
+                  'priority',
+                  'build_args',
+                  'builder_hostname',
+                  'superseded_by',
+                  'version')
+
+# every attribute a stored task can have, the only fields a list can ask for.
+task_fields = summary_fields + ('key',
+                                'events',
+                                'logs',
+                                'builder_ipaddress',
+                                'builder_version',
+                                'requested_sha',
+                                'git_sha',
+                                'build_cache_key',
+                                'build_cache_hit',
+                                'timings',
+                                'checkpoint',
+                                'heartbeat_at')
+
+_active_states = (State.pending,
+                  State.downloading,
+                  State.building,
+                  State.testing,
+                  State.pushing)
+
+_default_page_size = 100
+
+
+def _get_table(db=None):
+    if db is None:
+        db = get_boto3_resource('dynamodb')
+    return db.Table(_task_table_name)
+
+
+def _describe_table(table_name):
+    client = get_boto3_client('dynamodb')
     try:
-        print(client.describe_table(TableName=table_name))
-        return True
+        return client.describe_table(TableName=table_name)['Table']
     except Exception as e:
         if error_code_equals(e, 'ResourceNotFoundException'):
-            return False
+            return None
         raise e
 
 
-def create_task_table(db=get_boto3_resource('dynamodb')):
+def _table_exists(table_name):
+    return _describe_table(table_name) is not None
+
+
+def _task_key(task):
+    return _make_task_key(task.git_branch, task.git_tag, task.created_at)
+
+
+def _make_task_key(git_branch, git_tag, created_at):
+    return '{0}:{1}:{2}'.format(created_at.isoformat(),
+                                git_branch,
+                                git_tag)
+
+
+def _make_index(index_name, hash_key, range_key):
+    return {
+        'IndexName': index_name,
+        'KeySchema': [
+            {
+                'AttributeName': hash_key,
+                'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': range_key,
+                'KeyType': 'RANGE'
+            }
+        ],
+        'Projection': {
+            'ProjectionType': 'ALL'
+        },
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 3,
+            'WriteCapacityUnits': 2
+        }
+    }
+
+
+def _created_at_index():
+    return _make_index(_created_at_index_name, 'list_partition', 'created_at')
+
+
+def _state_index():
+    return _make_index(_state_index_name, 'state', 'created_at')
+
+
+def _modified_at_index():
+    return _make_index(_modified_at_index_name, 'list_partition', 'modified_at')
+
+
+def create_task_table(db=None):
     """
     creates a new table if it does not exits, blocks until it does.
+    an existing table is migrated to have the indexes this module queries.
     :param db: boto3.resource('dynamodb')
     """
     if _table_exists(_task_table_name):
+        migrate_task_table(db=db)
         return
 
+    if db is None:
+        db = get_boto3_resource('dynamodb')
+
     table = db.create_table(
         TableName=_task_table_name,
         KeySchema=[
@@ -50,6 +167,27 @@ def create_task_table(db=get_boto3_resource('dynamodb')):
                 'AttributeName': 'key',
                 'AttributeType': 'S'
             },
+            {
+                'AttributeName': 'list_partition',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'created_at',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'state',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'modified_at',
+                'AttributeType': 'S'
+            },
+        ],
+        GlobalSecondaryIndexes=[
+            _created_at_index(),
+            _state_index(),
+            _modified_at_index()
         ],
         ProvisionedThroughput={
             'ReadCapacityUnits': 3,
@@ -61,95 +199,559 @@ def create_task_table(db=get_boto3_resource('dynamodb')):
     print('table {0} created'.format(_task_table_name))
 
 
-def save_task(task, db=get_boto3_resource('dynamodb')):
-    table = db.Table(_task_table_name)
+def create_build_cache_table(db=None):
+    """
+    creates the build result cache table if it does not exits, blocks until it does.
+    :param db: boto3.resource('dynamodb')
+    """
+    if _table_exists(_build_cache_table_name):
+        return
+
+    if db is None:
+        db = get_boto3_resource('dynamodb')
+
+    table = db.create_table(
+        TableName=_build_cache_table_name,
+        KeySchema=[
+            {
+                'AttributeName': 'cache_key',
+                'KeyType': 'HASH'
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'cache_key',
+                'AttributeType': 'S'
+            }
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 1,
+            'WriteCapacityUnits': 1
+        }
+    )
+    table.meta.client.get_waiter('table_exists').wait(TableName=_build_cache_table_name)
+    print('table {0} created'.format(_build_cache_table_name))
+
+
+def save_build_result(cache_key, task, pushed_images, db=None):
+    """
+    records the images a successful build pushed, so a build of the same inputs can reuse them.
+    :param pushed_images: a dictionary of services_to_push image names to the 'image@digest' pushed.
+    """
+    if db is None:
+        db = get_boto3_resource('dynamodb')
+    db.Table(_build_cache_table_name).put_item(Item={
+        'cache_key': cache_key,
+        'git_repo': task.git_repo,
+        'git_sha': task.git_sha,
+        'task_key': _task_key(task),
+        'images': pushed_images,
+        'created_at': datetime.utcnow().isoformat()
+    })
+
+
+def load_build_result(cache_key, db=None):
+    """
+    returns the build result saved by save_build_result(), None if there is none.
+    """
+    if db is None:
+        db = get_boto3_resource('dynamodb')
+    response = db.Table(_build_cache_table_name).get_item(Key={'cache_key': cache_key})
+    return response.get('Item')
+
+
+def _wait_for_index(table_name, index_name, poll_interval=10):
+    from time import sleep
+    while True:
+        description = _describe_table(table_name)
+        for index in description.get('GlobalSecondaryIndexes', []):
+            if index['IndexName'] == index_name and index['IndexStatus'] == 'ACTIVE':
+                return
+        sleep(poll_interval)
+
+
+def _backfill_list_partition(db=None):
+    """
+    sets 'list_partition' on tasks saved before the created_at index existed.
+    """
+    table = _get_table(db)
+    count = 0
+    for page in _iter_pages(table.scan,
+                            page_size=_default_page_size,
+                            FilterExpression=Attr('list_partition').not_exists(),
+                            ProjectionExpression='git_repo, #key',
+                            ExpressionAttributeNames={'#key': 'key'}):
+        for item in page['Items']:
+            table.update_item(Key={'git_repo': item['git_repo'], 'key': item['key']},
+                              UpdateExpression='SET list_partition = :list_partition',
+                              ExpressionAttributeValues={':list_partition': _task_list_partition})
+            count += 1
+    print('backfilled {0} tasks on table {1}'.format(count, _task_table_name))
+
+
+def _create_index(index, attribute_names, db=None):
+    print('creating index {0} on table {1}'.format(index['IndexName'], _task_table_name))
+    get_boto3_client('dynamodb').update_table(
+        TableName=_task_table_name,
+        AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name in attribute_names],
+        GlobalSecondaryIndexUpdates=[
+            {'Create': index}
+        ])
+    _wait_for_index(_task_table_name, index['IndexName'])
+
+
+def migrate_task_table(db=None):
+    """
+    adds any missing global secondary indexes to an existing task table, blocks until they are active.
+    dynamodb only builds one index per update, so they are created one after another.
+    safe to run repeatedly, does nothing once the table is up to date.
+    :param db: boto3.resource('dynamodb')
+    """
+    description = _describe_table(_task_table_name)
+    existing = [index['IndexName'] for index in description.get('GlobalSecondaryIndexes', [])]
+
+    if _created_at_index_name not in existing:
+        _create_index(_created_at_index(), ('list_partition', 'created_at'), db=db)
+        _backfill_list_partition(db=db)
+
+    # every task already has 'state' and 'created_at', dynamodb backfills the index itself.
+    if _state_index_name not in existing:
+        _create_index(_state_index(), ('state', 'created_at'), db=db)
+
+    # list_partition was backfilled with the created_at index.
+    if _modified_at_index_name not in existing:
+        _create_index(_modified_at_index(), ('list_partition', 'modified_at'), db=db)
+
+
+def _task_db_key(task):
+    return {'git_repo': task.git_repo, 'key': _task_key(task)}
+
+
+def _raise_conflict(task, error):
+    if error_code_equals(error, 'ConditionalCheckFailedException'):
+        raise BobTaskConflictError('task {0} {1} was saved by another writer since version {2}'.format(
+            task.git_repo, _task_key(task), task.version))
+    raise error
+
+
+def save_task(task, db=None):
+    """
+    writes the whole task, use this when creating a task.
+    :raises BobTaskConflictError: the stored task has a different version than this one.
+    """
+    table = _get_table(db)
 
     task.modified_at = datetime.utcnow()
     dict = task.to_dict()
-    dict['key'] = '{0}:{1}:{2}'.format(task.created_at.isoformat(),
-                                       task.git_branch,
-                                       task.git_tag)
+    dict['key'] = _task_key(task)
+    dict['list_partition'] = _task_list_partition
+    dict['version'] = task.version + 1
+
+    try:
+        table.put_item(Item=dict,
+                       ConditionExpression=(Attr('git_repo').not_exists()
+                                            | Attr('version').not_exists()
+                                            | Attr('version').eq(task.version)))
+    except ClientError as e:
+        _raise_conflict(task, e)
+    task.version += 1
+    _invalidate_task(task)
+
+
+def save_new_tasks(tasks, db=None):
+    """
+    writes many newly created tasks in batches of up to 25.
+    the writes are not conditional, so only use this for tasks that were never saved.
+    """
+    table = _get_table(db)
+    modified_at = datetime.utcnow()
+    with table.batch_writer() as batch:
+        for task in tasks:
+            task.modified_at = modified_at
+            dict = task.to_dict()
+            dict['key'] = _task_key(task)
+            dict['list_partition'] = _task_list_partition
+            dict['version'] = task.version + 1
+            batch.put_item(Item=dict)
+
+    for task in tasks:
+        task.version += 1
+
+
+def _update_task(task, values, return_values='NONE', versioned=True, db=None):
+    """
+    sets only the given attributes of the stored task with an UpdateExpression,
+    conditional on the task's version so concurrent writers cannot clobber each other.
+    :param values: a list of (attribute_name, list_index, value), list_index is None for a whole attribute.
+    :param return_values: the dynamodb ReturnValues e.g. 'ALL_NEW' to get the stored task back from the write.
+    :param versioned: False to write without checking or changing the version, only for attributes
+                      no other writer sets, so they never make the state writes of a cancel look stale.
+    :return: the update_item response.
+    :raises BobTaskConflictError: the task was saved by another writer since it was loaded.
+    """
+    table = _get_table(db)
+    modified_at = datetime.utcnow()
+
+    names = {'#modified_at': 'modified_at', '#git_repo': 'git_repo'}
+    expression_values = {':modified_at': modified_at.isoformat()}
+    sets = ['#modified_at = :modified_at']
+    if versioned:
+        names['#version'] = 'version'
+        expression_values[':version'] = task.version + 1
+        sets.append('#version = :version')
+    for i, (name, index, value) in enumerate(values):
+        names['#' + name] = name
+        path = '#' + name if index is None else '#{0}[{1}]'.format(name, index)
+        sets.append('{0} = :v{1}'.format(path, i))
+        expression_values[':v{0}'.format(i)] = value
 
-    table.put_item(Item=dict)
+    # update_item would create a partial item for a missing task, so require one to exist.
+    if not versioned:
+        condition = 'attribute_exists(#git_repo)'
+    elif task.version:
+        condition = 'attribute_exists(#git_repo) AND #version = :expected_version'
+        expression_values[':expected_version'] = task.version
+    else:
+        condition = 'attribute_exists(#git_repo) AND attribute_not_exists(#version)'
+
+    try:
+        response = table.update_item(Key=_task_db_key(task),
+                                     UpdateExpression='SET ' + ', '.join(sets),
+                                     ConditionExpression=condition,
+                                     ExpressionAttributeNames=names,
+                                     ExpressionAttributeValues=expression_values,
+                                     ReturnValues=return_values)
+    except ClientError as e:
+        _raise_conflict(task, e)
+
+    if versioned:
+        task.version += 1
+    task.modified_at = modified_at
+    _invalidate_task(task)
+    return response
+
+
+def save_task_state(task, attributes=(), db=None):
+    """
+    writes the state, state_message and the events task.set_state() changed:
+    the previous event it finished and the event it appended.
+    :param attributes: other top level task attributes to write along with the state.
+    :return: the task as stored after the write, without a second read.
+    """
+    values = [('state', None, task.state),
+              ('state_message', None, task.state_message),
+              ('started_at', None, task.started_at),
+              ('finished_at', None, task.finished_at)]
+    values += [(name, None, getattr(task, name)) for name in attributes]
+    last = len(task.events) - 1
+    if last > 0:
+        values.append(('events', last - 1, task.events[last - 1]))
+        values.append(('events', last, task.events[last]))
+    else:
+        values.append(('events', None, task.events))
+    response = _update_task(task, values, return_values='ALL_NEW', db=db)
+    return Task.from_dict(response['Attributes'])
+
+
+def save_task_log(task, index, db=None):
+    """
+    writes the one log entry at index, as returned from task.save_log().
+    only the building worker writes the logs, so the write leaves the version alone.
+    :param index: the changed entry, None when the entries were reordered and all need writing.
+    """
+    # a list index can only be set once the list attribute exists.
+    if index is None or len(task.logs) == 1:
+        values = [('logs', None, task.logs)]
+    else:
+        values = [('logs', index, task.logs[index])]
+    _update_task(task, values, versioned=False, db=db)
+
+
+def save_task_attributes(task, names, db=None):
+    """
+    writes the given top level attributes of the task, leaving the version alone:
+    only use it for attributes the building worker alone sets, e.g. its timings and checkpoint.
+    :param names: the task attribute names e.g. ('builder_hostname', 'builder_version')
+    """
+    _update_task(task, [(name, None, getattr(task, name)) for name in names], versioned=False, db=db)
+
+
+def _cache_key(git_repo, key):
+    return 'task:{0}:{1}'.format(git_repo, key)
+
+
+def _invalidate_task(task):
+    get_task_cache().delete(_cache_key(task.git_repo, _task_key(task)))
 
 
 def load_task(git_repo,
               git_branch,
               git_tag,
               created_at,
-              db=get_boto3_resource('dynamodb')):
-    table = db.Table(_task_table_name)
+              cached=False,
+              db=None):
+    """
+    :param cached: read through the task cache (bob.common.cache), for readers that can show a task a
+                   little stale. writers must read the task itself, their writes are conditional on its version.
+    """
+    key = _make_task_key(git_branch, git_tag, created_at)
+    if cached:
+        item = get_task_cache().get(_cache_key(git_repo, key))
+        if item is not None:
+            return Task.from_dict(item)
+
+    table = _get_table(db)
     response = table.get_item(
         Key={
             'git_repo': git_repo,
-            'key': '{0}:{1}:{2}'.format(created_at.isoformat(),
-                                        git_branch,
-                                        git_tag)
+            'key': key
         }
     )
+    if 'Item' not in response:
+        return None
+
+    task = Task.from_dict(response['Item'])
+    if cached:
+        get_task_cache().set(_cache_key(git_repo, key), task)
+    return task
+
+
+def reload_task(task, db=None):
+    table = _get_table(db)
+    response = table.get_item(Key=_task_db_key(task))
+    return Task.from_dict(response['Item'])
+
+
+def load_task_state(task, db=None):
+    """
+    returns the stored state of the task, or None if the task is gone.
+    reads only the state attribute with an eventually consistent get, for cheap polling.
+    """
+    table = _get_table(db)
+    response = table.get_item(Key=_task_db_key(task),
+                              ProjectionExpression='#state',
+                              ExpressionAttributeNames={'#state': 'state'},
+                              ConsistentRead=False)
     if 'Item' in response:
-        return Task.from_dict(response['Item'])
+        return response['Item'].get('state')
     return None
 
 
-def reload_task(task, db=get_boto3_resource('dynamodb')):
-    table = db.Table(_task_table_name)
-    response = table.get_item(
-        Key={
-            'git_repo': task.git_repo,
-            'key': '{0}:{1}:{2}'.format(task.created_at.isoformat(),
-                                        task.git_branch,
-                                        task.git_tag)
-        }
-    )
-    return Task.from_dict(response['Item'])
+def encode_cursor(last_evaluated_key):
+    """
+    turns a dynamodb LastEvaluatedKey into an opaque url safe string.
+    """
+    if not last_evaluated_key:
+        return None
+    text = json.dumps(last_evaluated_key, sort_keys=True)
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
 
 
-def load_all_tasks(db=get_boto3_resource('dynamodb')):
-    table = db.Table(_task_table_name)
-    response = table.scan()
-    if 'Items' in response:
-        for task in response['Items']:
-            yield Task.from_dict(task)
+def decode_cursor(cursor):
+    """
+    the reverse of encode_cursor(), returns None for an empty cursor.
+    """
+    if not cursor:
+        return None
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
 
 
-def tasks_list(db=get_boto3_resource('dynamodb'), git_repo=None, git_branch=None, git_tag=None):
-    table = db.Table(_task_table_name)
-    db_filter = None
+def _iter_pages(method, page_size, cursor=None, **kwargs):
+    """
+    calls table.query() or table.scan() following LastEvaluatedKey, yields each response.
+    :param method: the bound table.query or table.scan method.
+    :param page_size: the maximum number of items dynamodb evaluates per request.
+    :param cursor: the LastEvaluatedKey to start from.
+    """
+    if page_size:
+        kwargs['Limit'] = page_size
+    while True:
+        if cursor:
+            kwargs['ExclusiveStartKey'] = cursor
+        response = method(**kwargs)
+        yield response
+        cursor = response.get('LastEvaluatedKey')
+        if not cursor:
+            return
 
+
+def _and(db_filter, condition):
+    return db_filter & condition if db_filter else condition
+
+
+def _list_tasks_request(table, git_repo=None, git_branch=None, git_tag=None, db_filter=None):
+    """
+    returns the (table.query, kwargs) that list the matching tasks newest first.
+    """
     if git_branch:
-        db_filter = db_filter & Attr('git_branch').eq(git_branch) if db_filter else Attr('git_branch').eq(git_branch)
+        db_filter = _and(db_filter, Attr('git_branch').eq(git_branch))
     if git_tag:
-        db_filter = db_filter & Attr('git_tag').eq(git_tag) if db_filter else Attr('git_tag').eq(git_tag)
+        db_filter = _and(db_filter, Attr('git_tag').eq(git_tag))
+
+    # the 'key' range starts with created_at, so a repo's tasks sort by creation time.
+    if git_repo:
+        kwargs = {'KeyConditionExpression': Key('git_repo').eq(git_repo),
+                  'ScanIndexForward': False}
+    else:
+        kwargs = {'IndexName': _created_at_index_name,
+                  'KeyConditionExpression': Key('list_partition').eq(_task_list_partition),
+                  'ScanIndexForward': False}
+
+    if db_filter:
+        kwargs['FilterExpression'] = db_filter
+
+    return table.query, kwargs
+
+
+def list_tasks_page(git_repo=None,
+                    git_branch=None,
+                    git_tag=None,
+                    page_size=_default_page_size,
+                    cursor=None,
+                    db=None):
+    """
+    returns one page of tasks newest first.
+    :param page_size: the maximum number of tasks read for this page, filters may return less.
+    :param cursor: the cursor returned from the previous page, None for the first page.
+    :return: (tasks, next_cursor) next_cursor is None on the last page.
+    """
+    method, kwargs = _list_tasks_request(_get_table(db), git_repo, git_branch, git_tag)
+    response = next(_iter_pages(method, page_size, decode_cursor(cursor), **kwargs))
+    tasks = [Task.from_dict(item) for item in response.get('Items', [])]
+    return tasks, encode_cursor(response.get('LastEvaluatedKey'))
+
+
+def _project(kwargs, fields):
+    """
+    adds a ProjectionExpression reading only the given task attributes,
+    plus the ones a task's key and links are made of.
+    :raises ValueError: a field is not one of task_fields.
+    """
+    unknown = set(fields) - set(task_fields)
+    if unknown:
+        raise ValueError('unknown task fields: {0}'.format(', '.join(sorted(unknown))))
+
+    names = {}
+    for name in set(fields) | {'git_repo', 'key', 'git_branch', 'git_tag', 'created_at', 'modified_at'}:
+        names['#' + name] = name
+    kwargs['ProjectionExpression'] = ', '.join(sorted(names))
+    kwargs['ExpressionAttributeNames'] = names
+    return kwargs
 
-    if db_filter and git_repo:
-        response = table.query(FilterExpression=db_filter, KeyConditionExpression=Key('git_repo').eq(git_repo))
+
+def list_task_items_page(git_repo=None,
+                         git_branch=None,
+                         git_tag=None,
+                         fields=summary_fields,
+                         since=None,
+                         page_size=_default_page_size,
+                         cursor=None,
+                         db=None):
+    """
+    returns one page of tasks as plain dictionaries of only the given fields, for the json api.
+    :param since: an isoformat modified_at, only the tasks changed after it are returned, oldest change first.
+                  without it the tasks are returned newest first.
+    :return: (items, next_cursor) next_cursor is None on the last page.
+    """
+    table = _get_table(db)
+    if since:
+        db_filter = None
+        if git_repo:
+            db_filter = _and(db_filter, Attr('git_repo').eq(git_repo))
+        if git_branch:
+            db_filter = _and(db_filter, Attr('git_branch').eq(git_branch))
+        if git_tag:
+            db_filter = _and(db_filter, Attr('git_tag').eq(git_tag))
+        kwargs = {'IndexName': _modified_at_index_name,
+                  'KeyConditionExpression': (Key('list_partition').eq(_task_list_partition)
+                                             & Key('modified_at').gt(since)),
+                  'ScanIndexForward': True}
+        if db_filter:
+            kwargs['FilterExpression'] = db_filter
+        method = table.query
     else:
-        response = table.scan()
+        method, kwargs = _list_tasks_request(table, git_repo, git_branch, git_tag)
+
+    response = next(_iter_pages(method, page_size, decode_cursor(cursor), **_project(kwargs, fields)))
+    return response.get('Items', []), encode_cursor(response.get('LastEvaluatedKey'))
+
+
+def _iter_tasks(method, kwargs, page_size, limit, cursor=None):
+    if limit is not None and limit <= 0:
+        return
+    count = 0
+    for response in _iter_pages(method, page_size, cursor, **kwargs):
+        for item in response.get('Items', []):
+            yield Task.from_dict(item)
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+
+def list_tasks(git_repo=None,
+               git_branch=None,
+               git_tag=None,
+               page_size=_default_page_size,
+               limit=None,
+               cursor=None,
+               db=None):
+    """
+    lazily yields tasks newest first, only reading as many pages as are consumed.
+    :param page_size: the number of items read from dynamodb per request.
+    :param limit: the maximum number of tasks to yield, None for all.
+    :param cursor: a cursor from list_tasks_page() to continue from.
+    """
+    method, kwargs = _list_tasks_request(_get_table(db), git_repo, git_branch, git_tag)
+    return _iter_tasks(method, kwargs, page_size, limit, decode_cursor(cursor))
+
+
+def load_all_tasks(db=None):
+    return list_tasks(db=db)
 
-    if 'Items' in response:
-        for task in response['Items']:
-            yield Task.from_dict(task)
 
+def tasks_list(db=None, git_repo=None, git_branch=None, git_tag=None, limit=None):
+    return list_tasks(git_repo=git_repo, git_branch=git_branch, git_tag=git_tag, limit=limit, db=db)
 
-def tasks_ps(db=get_boto3_resource('dynamodb'), git_repo=None, git_branch=None, git_tag=None):
-    table = db.Table(_task_table_name)
-    db_filter = (Attr('state').eq(State.pending)
-                 | Attr('state').eq(State.downloading)
-                 | Attr('state').eq(State.building)
-                 | Attr('state').eq(State.testing)
-                 | Attr('state').eq(State.pushing))
+
+def _list_state_request(table, state, git_repo=None, git_branch=None, git_tag=None):
+    """
+    returns the (table.query, kwargs) that list the tasks in the given state newest first.
+    """
+    db_filter = None
+    if git_repo:
+        db_filter = _and(db_filter, Attr('git_repo').eq(git_repo))
     if git_branch:
-        db_filter = db_filter & Attr('git_branch').eq(git_branch)
+        db_filter = _and(db_filter, Attr('git_branch').eq(git_branch))
     if git_tag:
-        db_filter = db_filter & Attr('git_tag').eq(git_tag)
+        db_filter = _and(db_filter, Attr('git_tag').eq(git_tag))
 
-    if db_filter and git_repo:
-        response = table.query(FilterExpression=db_filter, KeyConditionExpression=Key('git_repo').eq(git_repo))
-    else:
-        response = table.scan()
+    kwargs = {'IndexName': _state_index_name,
+              'KeyConditionExpression': Key('state').eq(state),
+              'ScanIndexForward': False}
+
+    if db_filter:
+        kwargs['FilterExpression'] = db_filter
+
+    return table.query, kwargs
+
+
+def tasks_ps(db=None, git_repo=None, git_branch=None, git_tag=None, limit=None):
+    """
+    lazily yields the tasks that are in progress newest first,
+    merging one state index query per active state.
+    """
+    table = _get_table(db)
+    queries = []
+    for state in _active_states:
+        method, kwargs = _list_state_request(table, state, git_repo, git_branch, git_tag)
+        queries.append(_iter_tasks(method, kwargs, _default_page_size, limit))
+
+    tasks = heapq.merge(*queries, key=lambda task: task.created_at, reverse=True)
+    return _limit(tasks, limit)
 
-    if 'Items' in response:
-        for task in response['Items']:
-            yield Task.from_dict(task)
 
+def _limit(tasks, limit):
+    for count, task in enumerate(tasks):
+        if limit is not None and count >= limit:
+            return
+        yield task
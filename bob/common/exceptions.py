@@ -16,3 +16,12 @@ class BobProcessExecutionError(BobTheBuilderException):
     def __repr__(self):
         return '{0}\ncmd:{1}\nreturncode:{2}'.format(self.message, self.cmd, self.returncode)
 
+
+
+class BobTaskConflictError(BobTheBuilderException):
+    """
+    raised when a conditional task write finds the task was saved by someone else since it was loaded.
+    """
+    def __init__(self, message):
+        super(BobTaskConflictError, self).__init__(message)
+        self.message = message
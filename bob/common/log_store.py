@@ -0,0 +1,126 @@
+import os
+from os.path import expanduser
+
+from bob.common.aws import load_settings, get_boto3_resource
+from bob.common.tools import mkdir_p
+
+
+def get_log_key(task, filename):
+    """
+    returns the store key for one of the task's log files, laid out like the worker's build path.
+    """
+    return '{git_repo}/{git_branch}/{git_tag}/{created_at}/{filename}'.format(
+        git_repo=task.git_repo,
+        git_branch=task.git_branch,
+        git_tag=task.git_tag,
+        created_at=task.created_at.strftime("%Y%m%d%H%M%S%f"),
+        filename=filename)
+
+
+def _chunk_name(index):
+    return '{0:08d}'.format(index)
+
+
+class LogStore(object):
+    """
+    append only log storage, each append writes a new chunk object '<log key>/<chunk index>'.
+    the task item only keeps the number of chunks and bytes written, see Task.set_log().
+    a store provides write_chunk(log_key, index, data) and read_chunk(log_key, index).
+    """
+
+    def append(self, log_key, chunks, data):
+        """
+        :param chunks: the number of chunks already written for log_key.
+        :return: the new number of chunks.
+        """
+        self.write_chunk(log_key, chunks, data)
+        return chunks + 1
+
+    def read(self, log_key, chunks):
+        """
+        returns all the bytes written for log_key.
+        """
+        return b''.join(self.read_chunk(log_key, index) for index in range(chunks))
+
+    def tail(self, log_key, chunks, max_bytes=10 * 1024):
+        """
+        returns at most max_bytes from the end of the log, only reading the chunks it needs.
+        """
+        data = b''
+        index = chunks - 1
+        while index >= 0 and len(data) < max_bytes:
+            data = self.read_chunk(log_key, index) + data
+            index -= 1
+        return data[-max_bytes:]
+
+
+class FileLogStore(LogStore):
+    """
+    keeps the chunks on the local filesystem, for a single host install and testing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _chunk_path(self, log_key, index):
+        return os.path.join(self.path, log_key, _chunk_name(index))
+
+    def write_chunk(self, log_key, index, data):
+        path = self._chunk_path(log_key, index)
+        mkdir_p(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read_chunk(self, log_key, index):
+        try:
+            with open(self._chunk_path(log_key, index), 'rb') as f:
+                return f.read()
+        except IOError:
+            return b''
+
+
+class S3LogStore(LogStore):
+    """
+    keeps the chunks as objects in an s3 bucket.
+    """
+
+    def __init__(self, bucket, prefix='logs', s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3 if s3 else get_boto3_resource('s3')
+
+    def _object(self, log_key, index):
+        return self.s3.Object(self.bucket, '{0}/{1}/{2}'.format(self.prefix, log_key, _chunk_name(index)))
+
+    def write_chunk(self, log_key, index, data):
+        self._object(log_key, index).put(Body=data, ContentType='text/plain')
+
+    def read_chunk(self, log_key, index):
+        try:
+            return self._object(log_key, index).get()['Body'].read()
+        except self.s3.meta.client.exceptions.NoSuchKey:
+            return b''
+
+
+def get_log_store():
+    """
+    returns the log store configured under 'log_store' in aws-settings.yml e.g.
+        log_store:
+          s3_bucket: bob-logs
+          s3_prefix: logs
+    or
+        log_store:
+          path: /var/lib/bob/logs
+    defaults to ~/bob/logs on the local filesystem.
+    """
+    settings = load_settings() or {}
+    log_settings = settings.get('log_store') or {}
+
+    if log_settings.get('s3_bucket'):
+        return S3LogStore(log_settings['s3_bucket'], log_settings.get('s3_prefix', 'logs'))
+
+    return FileLogStore(log_settings.get('path', os.path.join(expanduser("~"), 'bob/logs')))
+
+
+def decode_log(data):
+    return data.decode('utf-8', 'replace')
@@ -1,11 +1,36 @@
+import json
 from botocore.exceptions import ClientError
 from bob.common.aws import get_boto3_resource
+from bob.common.task import Priority, Task
 
 from bob.worker.aws_helpers import error_code_equals
 
 _task_queue_name = 'bob-task'
 #_task_queue_name = 'bob-task-test'
 
+# one queue per priority, normal keeps the original queue so tasks already queued are still built.
+_priority_queue_names = {Priority.high: _task_queue_name + '-high',
+                         Priority.normal: _task_queue_name,
+                         Priority.low: _task_queue_name + '-low'}
+
+# the builds web hooks asked for, held here until the web server has saved and queued them as tasks.
+_webhook_queue_name = 'bob-webhook'
+
+# queue urls never change, so they are looked up once per process.
+_queue_urls = {}
+
+
+def _get_sqs(sqs=None):
+    return sqs if sqs is not None else get_boto3_resource('sqs')
+
+
+def _get_queue(queue_name, sqs):
+    url = _queue_urls.get(queue_name)
+    if url is None:
+        url = sqs.get_queue_by_name(QueueName=queue_name).url
+        _queue_urls[queue_name] = url
+    return sqs.Queue(url)
+
 
 def _queue_exists(queue_name, sqs):
     try:
@@ -18,15 +43,75 @@ def _queue_exists(queue_name, sqs):
         raise err
 
 
-def create_task_queue(sqs=get_boto3_resource('sqs')):
-    if _queue_exists(_task_queue_name, sqs=sqs):
+def create_task_queue(sqs=None):
+    """
+    creates the task queue of every priority.
+    """
+    sqs = _get_sqs(sqs)
+    for queue_name in _priority_queue_names.values():
+        if _queue_exists(queue_name, sqs=sqs):
+            continue
+        sqs.create_queue(QueueName=queue_name,
+                         Attributes={'VisibilityTimeout': '60',
+                                     'ReceiveMessageWaitTimeSeconds': '15'})
+
+
+def create_webhook_queue(sqs=None):
+    sqs = _get_sqs(sqs)
+    if _queue_exists(_webhook_queue_name, sqs=sqs):
         return
-    sqs.create_queue(QueueName=_task_queue_name,
-                     Attributes={'VisibilityTimeout': '60',
-                                 'ReceiveMessageWaitTimeSeconds': '15'})
+    sqs.create_queue(QueueName=_webhook_queue_name,
+                     Attributes={'VisibilityTimeout': '120',
+                                 'ReceiveMessageWaitTimeSeconds': '20',
+                                 'MessageRetentionPeriod': str(4 * 24 * 60 * 60)})
+
+
+def send_webhook_build(task, debounce_seconds=None, sqs=None):
+    """
+    queues a build a web hook asked for, see receive_webhook_builds().
+    :param debounce_seconds: how long to wait for a newer build of the same repo, branch and tag to replace it.
+    """
+    body = json.dumps({'task': task.to_dict(), 'debounce_seconds': debounce_seconds})
+    _get_queue(_webhook_queue_name, _get_sqs(sqs)).send_message(MessageBody=body)
+
 
+def receive_webhook_builds(max_messages=10, wait_seconds=20, sqs=None):
+    """
+    long polls for the builds send_webhook_build() queued.
+    :return: a list of (task, debounce_seconds, message), the message is deleted once the task is saved.
+    """
+    queue = _get_queue(_webhook_queue_name, _get_sqs(sqs))
+    builds = []
+    for message in receive_tasks(queue, max_messages, wait_seconds):
+        try:
+            body = json.loads(message.body)
+            builds.append((Task.from_dict(body['task']), body.get('debounce_seconds'), message))
+        except (ValueError, KeyError, TypeError) as ex:
+            print('dropping an unreadable web hook build: {0} {1}'.format(ex, message.body))
+            message.delete()
+    return builds
 
-def _create_task_cancel_queue(sqs=get_boto3_resource('sqs')):
+
+def delete_messages(messages, sqs=None):
+    """
+    deletes the received messages, batched per queue.
+    """
+    sqs = _get_sqs(sqs)
+    by_queue = {}
+    for message in messages:
+        by_queue.setdefault(message.queue_url, []).append(message)
+
+    for queue_url, queue_messages in by_queue.items():
+        for start in range(0, len(queue_messages), 10):
+            entries = [{'Id': str(i), 'ReceiptHandle': message.receipt_handle}
+                       for i, message in enumerate(queue_messages[start:start + 10])]
+            response = sqs.Queue(queue_url).delete_messages(Entries=entries)
+            for failed in response.get('Failed', []):
+                print('failed to delete a message: {0}'.format(failed.get('Message')))
+
+
+def _create_task_cancel_queue(sqs=None):
+    sqs = _get_sqs(sqs)
     if _queue_exists(_task_queue_name, sqs=sqs):
         return
     sqs.create_queue(QueueName=_task_queue_name,
@@ -34,11 +119,76 @@ def _create_task_cancel_queue(sqs=get_boto3_resource('sqs')):
                                  'ReceiveMessageWaitTimeSeconds': '15'})
 
 
-def enqueue_task(task, sqs=get_boto3_resource('sqs')):
-    queue = sqs.get_queue_by_name(QueueName=_task_queue_name)
+def enqueue_task(task, sqs=None):
+    queue = get_task_queue(task.priority, sqs)
     queue.send_message(MessageBody=str(task))
 
 
-def get_task_queue(sqs=get_boto3_resource('sqs')):
-    return sqs.get_queue_by_name(QueueName=_task_queue_name)
+def enqueue_tasks(tasks, sqs=None):
+    """
+    queues many tasks, ten messages per request.
+    :return: the tasks that failed to queue.
+    """
+    sqs = _get_sqs(sqs)
+    by_priority = {}
+    for task in tasks:
+        by_priority.setdefault(task.priority, []).append(task)
+
+    failed_tasks = []
+    for priority, priority_tasks in by_priority.items():
+        queue = get_task_queue(priority, sqs)
+        for start in range(0, len(priority_tasks), 10):
+            batch = priority_tasks[start:start + 10]
+            entries = [{'Id': str(i), 'MessageBody': str(task)} for i, task in enumerate(batch)]
+            response = queue.send_messages(Entries=entries)
+            for failed in response.get('Failed', []):
+                print('failed to queue a task: {0}'.format(failed.get('Message')))
+                failed_tasks.append(batch[int(failed['Id'])])
+    return failed_tasks
+
+
+def get_task_queue(priority=Priority.normal, sqs=None):
+    return _get_queue(_priority_queue_names[priority], _get_sqs(sqs))
+
+
+def get_task_queues(sqs=None):
+    """
+    returns a dictionary of each priority to its task queue.
+    """
+    sqs = _get_sqs(sqs)
+    return dict((priority, get_task_queue(priority, sqs)) for priority in Priority.all)
+
+
+
+def receive_tasks(queue, max_messages=1, wait_seconds=20):
+    """
+    long polls the queue for up to max_messages (at most 10), waiting up to wait_seconds (at most 20) for one.
+    """
+    return queue.receive_messages(MaxNumberOfMessages=max(1, min(max_messages, 10)),
+                                  WaitTimeSeconds=max(0, min(int(wait_seconds), 20)),
+                                  AttributeNames=['ApproximateReceiveCount'])
+
+
+def get_receive_count(message):
+    return int((message.attributes or {}).get('ApproximateReceiveCount', 1))
+
+
+def change_visibility(messages, visibility_timeout, sqs=None):
+    """
+    sets how much longer the received messages stay hidden from other workers, batched per queue.
+    """
+    sqs = _get_sqs(sqs)
+    by_queue = {}
+    for message in messages:
+        by_queue.setdefault(message.queue_url, []).append(message)
 
+    for queue_url, queue_messages in by_queue.items():
+        for start in range(0, len(queue_messages), 10):
+            entries = []
+            for i, message in enumerate(queue_messages[start:start + 10]):
+                entries.append({'Id': str(i),
+                                'ReceiptHandle': message.receipt_handle,
+                                'VisibilityTimeout': visibility_timeout})
+            response = sqs.Queue(queue_url).change_message_visibility_batch(Entries=entries)
+            for failed in response.get('Failed', []):
+                print('failed to change the visibility of a message: {0}'.format(failed.get('Message')))
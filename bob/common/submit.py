@@ -0,0 +1,78 @@
+from bob.common.task import State
+from bob.common.exceptions import BobTaskConflictError
+from bob.common import db
+from bob.common import queues
+
+
+def _supersede(old_task, task, cancel_running):
+    """
+    cancels a pending task outright, a running one is marked cancel for its worker to stop.
+    returns True if the task was superseded.
+    """
+    if old_task.state == State.pending:
+        state = State.canceled
+    elif cancel_running:
+        state = State.cancel
+    else:
+        return False
+
+    old_task.set_state(state, 'superseded by the task created at {0}'.format(task.created_at.isoformat()))
+    old_task.superseded_by = task.created_at.isoformat()
+    try:
+        db.save_task_state(old_task, attributes=('superseded_by',))
+    except BobTaskConflictError:
+        # a worker picked it up meanwhile, it is running now.
+        if old_task.state == State.canceled and cancel_running:
+            return _supersede(db.reload_task(old_task), task, cancel_running)
+        return False
+    return True
+
+
+def supersede_tasks(task, cancel_running=False):
+    """
+    cancels the older tasks still waiting for, or with cancel_running building, the same repo, branch and tag.
+    each is recorded as canceled with superseded_by pointing at the task that replaced it.
+    :return: the tasks superseded.
+    """
+    superseded = []
+    for old_task in db.tasks_ps(git_repo=task.git_repo, git_branch=task.git_branch, git_tag=task.git_tag):
+        if old_task.created_at >= task.created_at:
+            continue
+        if _supersede(old_task, task, cancel_running):
+            print('superseded task: {0} {1} {2} {3}'.format(
+                old_task.git_repo, old_task.git_branch, old_task.git_tag, old_task.created_at.isoformat()))
+            superseded.append(old_task)
+    return superseded
+
+
+def submit_task(task, supersede=True, cancel_running=False):
+    """
+    saves and queues a new task, coalescing the queue so only the newest build of a repo, branch and tag waits.
+    :param supersede: cancel the older pending tasks of the same repo, branch and tag.
+    :param cancel_running: also cancel their builds that are already running.
+    :return: the tasks superseded.
+    """
+    db.save_task(task)
+    queues.enqueue_task(task)
+    if not supersede:
+        return []
+    return supersede_tasks(task, cancel_running=cancel_running)
+
+
+def submit_tasks(tasks, supersede=True, cancel_running=False):
+    """
+    saves and queues many new tasks with batched writes, then supersedes the older builds of each.
+    :return: the tasks superseded.
+    """
+    if not tasks:
+        return []
+    db.save_new_tasks(tasks)
+    for task in queues.enqueue_tasks(tasks):
+        queues.enqueue_task(task)
+    if not supersede:
+        return []
+
+    superseded = []
+    for task in tasks:
+        superseded.extend(supersede_tasks(task, cancel_running=cancel_running))
+    return superseded
@@ -15,13 +15,33 @@ class State(object):
     failed = 'failed'
 
 
+class Priority(object):
+    high = 'high'
+    normal = 'normal'
+    low = 'low'
+    all = (high, normal, low)
+
+    @staticmethod
+    def get_default(git_tag, created_by):
+        """
+        release tags come first, then branch builds, then builds started by hand from the cli.
+        """
+        if git_tag and git_tag != 'latest':
+            return Priority.high
+        if created_by and not created_by.startswith('github') and created_by != 'website':
+            return Priority.low
+        return Priority.normal
+
+
 class Task(object):
     def __init__(self,
                  git_repo,
                  git_branch='master',
                  git_tag='latest',
                  build_args=[],
-                 created_by=None
+                 created_by=None,
+                 priority=None,
+                 requested_sha=None
                  ):
         self.git_repo = git_repo
         self.git_branch = git_branch if git_branch else 'master'
@@ -31,12 +51,32 @@ class Task(object):
         self.logs = []
         self.created_at = datetime.datetime.utcnow()
         self.created_by = created_by
+        self.priority = priority if priority in Priority.all else Priority.get_default(git_tag, created_by)
         self.modified_at = self.created_at
         self.builder_ipaddress = None
         self.builder_hostname = None
         self.builder_version = None
+        # the commit to build e.g. the one a push event was for, the branch's newest commit is built when None.
+        self.requested_sha = requested_sha
+        # the commit the source was resolved to, and the build cache entry it was built or reused from.
+        self.git_sha = None
+        self.build_cache_key = None
+        self.build_cache_hit = False
+        # when the build left pending and when it was done, so a duration needs no events.
+        self.started_at = None
+        self.finished_at = None
+        # refreshed by the worker building the task while it is alive.
+        self.heartbeat_at = None
+        # the created_at of the newer task of the same repo, branch and tag that replaced this one.
+        self.superseded_by = None
+        # what the finished stages produced, so a failed build can be resumed after its last good stage.
+        self.checkpoint = {}
+        # how long each step inside a state took e.g. building every service of a parallel build.
+        self.timings = []
         self.state = None
         self.state_message = None
+        # incremented on every save, db writes are conditional on it.
+        self.version = 0
         self.set_state(State.pending, 'task is waiting to be processed')
 
     def __repr__(self):
@@ -72,6 +112,10 @@ class Task(object):
         return ''
 
     def get_duration(self):
+        if self.started_at:
+            to_date = parse_date(self.finished_at) if self.finished_at else datetime.datetime.utcnow()
+            return ':'.join(str(to_date - parse_date(self.started_at)).split(':')[:2])
+
         if len(self.events) <= 1:
             from_date = self.created_at
             to_date = datetime.datetime.utcnow()
@@ -109,6 +153,15 @@ class Task(object):
         self.state_message = message
         self.events.append(event)
 
+        if state == State.pending:
+            # a resumed task starts timing again.
+            self.started_at = None
+            self.finished_at = None
+        elif not self.started_at:
+            self.started_at = now.isoformat()
+        if self.is_done():
+            self.finished_at = now.isoformat()
+
     def get_events(self):
         for event in self.events:
             duration = event['duration']
@@ -122,6 +175,17 @@ class Task(object):
                 'duration': duration
             }
 
+    def add_timing(self, name, started_at, finished_at, result):
+        """
+        records how long a step took.
+        :param result: how the step ended e.g. 'successful' or 'failed'
+        """
+        self.timings.append({'name': name,
+                             'started_at': started_at.isoformat(),
+                             'finished_at': finished_at.isoformat(),
+                             'duration': str(finished_at - started_at),
+                             'result': result})
+
     @staticmethod
     def from_json(text):
         return Task.from_dict(json.loads(text))
@@ -132,16 +196,32 @@ class Task(object):
                     git_branch=dict['git_branch'],
                     git_tag=dict['git_tag'],
                     build_args=dict.get('build_args', []),
-                    created_by=dict.get('created_by', None))
+                    created_by=dict.get('created_by', None),
+                    priority=dict.get('priority'),
+                    requested_sha=dict.get('requested_sha'))
         task.state = dict['state']
         task.state_message = dict.get('state_message')
         task.events = dict.get('events', [])
         task.logs = dict.get('logs', [])
+        for entry in task.logs:
+            for name in ('size', 'chunks'):
+                if name in entry:
+                    entry[name] = int(entry[name])
         task.created_at = parse_date(dict['created_at'])
         task.modified_at = parse_date(dict['modified_at'])
         task.builder_ipaddress = dict.get('builder_ipaddress', '')
         task.builder_hostname = dict.get('builder_hostname', '')
         task.builder_version = dict.get('builder_version', '')
+        task.git_sha = dict.get('git_sha')
+        task.build_cache_key = dict.get('build_cache_key')
+        task.build_cache_hit = dict.get('build_cache_hit', False)
+        task.timings = dict.get('timings', [])
+        task.checkpoint = dict.get('checkpoint', {})
+        task.superseded_by = dict.get('superseded_by')
+        task.started_at = dict.get('started_at')
+        task.finished_at = dict.get('finished_at')
+        task.heartbeat_at = dict.get('heartbeat_at')
+        task.version = int(dict.get('version', 0))
         return task
 
     def to_dict(self):
@@ -152,7 +232,9 @@ class Task(object):
                 'build_args': self.build_args,
                 'state': self.state,
                 'created_at': self.created_at.isoformat(),
-                'modified_at': self.modified_at.isoformat()
+                'modified_at': self.modified_at.isoformat(),
+                'priority': self.priority,
+                'version': self.version
             }
 
         if self.created_by:
@@ -176,18 +258,59 @@ class Task(object):
         if self.builder_version:
             result['builder_version'] = self.builder_version
 
+        if self.requested_sha:
+            result['requested_sha'] = self.requested_sha
+
+        if self.git_sha:
+            result['git_sha'] = self.git_sha
+
+        if self.build_cache_key:
+            result['build_cache_key'] = self.build_cache_key
+            result['build_cache_hit'] = self.build_cache_hit
+
+        if self.timings:
+            result['timings'] = self.timings
+
+        if self.checkpoint:
+            result['checkpoint'] = self.checkpoint
+
+        if self.superseded_by:
+            result['superseded_by'] = self.superseded_by
+
+        if self.started_at:
+            result['started_at'] = self.started_at
+
+        if self.finished_at:
+            result['finished_at'] = self.finished_at
+
+        if self.heartbeat_at:
+            result['heartbeat_at'] = self.heartbeat_at
+
         return result
 
-    def save_log(self, text, log_path, insert_first=False):
+    def can_resume(self):
+        return self.state in (State.failed, State.canceled) and bool(self.checkpoint)
+
+    def get_log(self, filename):
+        for entry in self.logs:
+            if entry['filename'] == filename:
+                return entry
+        return None
+
+    def set_log(self, log_path, size, chunks, insert_first=False):
+        """
+        adds or replaces the pointer to the log_path's file in the log store.
+        the text lives in the log store (bob.common.log_store), the task only keeps its size in bytes
+        and the number of chunks written.
+        :return: the index of the changed entry, or None if the entries were reordered.
+        """
         import os
-        if not text or len(text) == 0:
-            return
-
         filename = os.path.basename(log_path)
 
         entry = {'filename': filename,
-                 'path:': log_path,
-                 'text': text,
+                 'path': log_path,
+                 'size': size,
+                 'chunks': chunks,
                  'created_at': datetime.datetime.utcnow().isoformat()}
 
         index = -1
@@ -199,7 +322,9 @@ class Task(object):
         if index < 0:
             if insert_first:
                 self.logs.insert(0, entry)
-            else:
-                self.logs.append(entry)
-        else:
-            self.logs[index] = entry
+                return 0 if len(self.logs) == 1 else None
+            self.logs.append(entry)
+            return len(self.logs) - 1
+
+        self.logs[index] = entry
+        return index
@@ -1,5 +1,6 @@
 import errno
 import os
+from decimal import Decimal
 
 
 def mkdir_p(path):
@@ -16,3 +17,16 @@ def mkdir_if_not_exist(path):
     if not os.path.exists(path):
         mkdir_p(path)
     return path
+
+
+def to_json_value(value):
+    """
+    dynamodb returns numbers as Decimal, which json cannot encode.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return dict((key, to_json_value(value[key])) for key in value)
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+    return value
@@ -0,0 +1,24 @@
+# the bob-web console script. the gevent workers need ssl, sockets and threads patched before boto3, urllib3
+# or flask import them, so nothing else is imported here until gevent has patched them.
+
+
+def patch_gevent():
+    """
+    patches gevent in, returns False if it is not installed.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    monkey.patch_all()
+    return True
+
+
+def main():
+    patch_gevent()
+    from bob.webserver import web_server
+    web_server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from time import sleep, time
+from dateutil.parser import parse as parse_date
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from bob.common import db
+from bob.common.tools import to_json_value
+from bob.common.log_store import get_log_store, get_log_key, decode_log
+
+
+def format_event(event, data):
+    """
+    returns a server sent event, data is sent as json.
+    """
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+
+
+def _state_data(task):
+    return {'state': task.state,
+            'state_message': task.get_state_message(),
+            'duration': task.get_duration(),
+            'events': list(task.get_events())}
+
+
+class TaskPoller(object):
+    """
+    watches one task, each poll() returns its state changes and the log text appended since the last poll.
+    """
+
+    def __init__(self, git_repo, git_branch, git_tag, created_at, tail_bytes=10 * 1024):
+        self.key = (git_repo, git_branch, git_tag, created_at)
+        self.tail_bytes = tail_bytes
+        self.task = None
+        self.log_chunks = {}
+        self.done = False
+
+    def _load(self):
+        return db.load_task(*self.key, cached=True)
+
+    def snapshot(self):
+        """
+        returns the messages a new subscriber starts from: the state and the tail of each log,
+        up to exactly where the following poll() messages carry on.
+        """
+        if self.task is None:
+            self.task = self._load()
+            if not self.task:
+                self.done = True
+                return [('missing', {})]
+            self.log_chunks = dict((log['filename'], log.get('chunks', 0)) for log in self.task.logs)
+
+        messages = [('state', _state_data(self.task))]
+        log_store = get_log_store()
+        for log in self.task.logs:
+            filename = log['filename']
+            chunks = self.log_chunks.get(filename, 0)
+            text = decode_log(log_store.tail(get_log_key(self.task, filename), chunks, self.tail_bytes))
+            messages.append(('log', {'filename': filename, 'text': text, 'reset': True}))
+
+        if self.task.is_done():
+            self.done = True
+            messages.append(('done', {'state': self.task.state}))
+        return messages
+
+    def poll(self):
+        task = self._load()
+        if not task:
+            self.done = True
+            return [('missing', {})]
+
+        previous = self.task
+        self.task = task
+        # log writes change modified_at but not the version.
+        if previous.version == task.version and previous.modified_at == task.modified_at:
+            return []
+
+        messages = []
+        if previous.state != task.state or len(previous.events) != len(task.events):
+            messages.append(('state', _state_data(task)))
+        messages.extend(self._read_new_log_text(task))
+
+        if task.is_done():
+            self.done = True
+            messages.append(('done', {'state': task.state}))
+        return messages
+
+    def _read_new_log_text(self, task):
+        log_store = get_log_store()
+        messages = []
+        for log in task.logs:
+            if 'chunks' not in log:
+                continue
+            filename = log['filename']
+            chunks = log['chunks']
+            read_from = self.log_chunks.get(filename, 0)
+            # the log was written again from the start.
+            reset = chunks < read_from
+            if reset:
+                read_from = 0
+            elif chunks == read_from:
+                continue
+
+            log_key = get_log_key(task, filename)
+            text = ''.join(decode_log(log_store.read_chunk(log_key, index)) for index in range(read_from, chunks))
+            self.log_chunks[filename] = chunks
+            messages.append(('log', {'filename': filename, 'text': text, 'reset': reset}))
+        return messages
+
+
+class TaskListPoller(object):
+    """
+    watches every task, each poll() returns the summary of the tasks changed since the last poll.
+    """
+
+    def __init__(self, overlap_seconds=120):
+        self.since = datetime.utcnow().isoformat()
+        self.overlap = timedelta(seconds=overlap_seconds)
+        self.versions = {}
+        self.done = False
+
+    def snapshot(self):
+        return []
+
+    def poll(self):
+        # the workers' clocks may be a little behind, so look back a little and drop what was already sent.
+        since = (parse_date(self.since) - self.overlap).isoformat()
+
+        messages = []
+        cursor = None
+        while True:
+            items, cursor = db.list_task_items_page(since=since, cursor=cursor)
+            for item in items:
+                item_key = (item['git_repo'], item['key'])
+                version = int(item.get('version', 0))
+                if self.versions.get(item_key) == version:
+                    continue
+                self.versions[item_key] = version
+                self.since = max(self.since, item['modified_at'])
+                messages.append(('task', to_json_value(item)))
+            if not cursor:
+                break
+
+        # a forgotten version only means a task is sent again.
+        if len(self.versions) > 10000:
+            self.versions = {}
+        return messages
+
+
+class _Topic(object):
+    def __init__(self, poller):
+        self.poller = poller
+        self.subscribers = []
+        # subscribers still taking their snapshot, the topic is kept running for them.
+        self.joining = 0
+        # a new subscriber's snapshot and the polls are taken in turn, so none of the stream is missed or repeated.
+        self.poll_lock = threading.Lock()
+
+
+class StreamHub(object):
+    """
+    fans one poller per topic out to every subscriber in this process,
+    so the database is read once per poll_interval however many browsers are watching.
+    """
+
+    def __init__(self, poll_interval=2):
+        self.poll_interval = poll_interval
+        self.topics = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, key, create_poller):
+        """
+        returns a queue of (event, data) messages for the topic, starting with its current snapshot.
+        a None message means the topic has ended.
+        """
+        subscriber = Queue()
+        with self.lock:
+            topic = self.topics.get(key)
+            start = topic is None
+            if start:
+                topic = _Topic(create_poller())
+                self.topics[key] = topic
+            topic.joining += 1
+
+        with topic.poll_lock:
+            try:
+                for message in topic.poller.snapshot():
+                    subscriber.put(message)
+            finally:
+                with self.lock:
+                    topic.joining -= 1
+                    if not topic.poller.done:
+                        topic.subscribers.append(subscriber)
+            if topic.poller.done:
+                subscriber.put(None)
+
+        if start:
+            thread = threading.Thread(target=self._run, args=(key, topic))
+            thread.daemon = True
+            thread.start()
+        return subscriber
+
+    def unsubscribe(self, key, subscriber):
+        with self.lock:
+            topic = self.topics.get(key)
+            if topic and subscriber in topic.subscribers:
+                topic.subscribers.remove(subscriber)
+
+    def _end(self, key, topic):
+        with self.lock:
+            if self.topics.get(key) is topic:
+                del self.topics[key]
+            subscribers = list(topic.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(None)
+
+    def _run(self, key, topic):
+        while True:
+            sleep(self.poll_interval)
+
+            with self.lock:
+                if not topic.subscribers and not topic.joining:
+                    if self.topics.get(key) is topic:
+                        del self.topics[key]
+                    return
+
+            with topic.poll_lock:
+                if topic.poller.done:
+                    self._end(key, topic)
+                    return
+
+                try:
+                    messages = topic.poller.poll()
+                except Exception as ex:
+                    print('stream {0} poll failed: {1}'.format(key, ex))
+                    messages = []
+
+                with self.lock:
+                    subscribers = list(topic.subscribers)
+                for message in messages:
+                    for subscriber in subscribers:
+                        subscriber.put(message)
+
+                if topic.poller.done:
+                    self._end(key, topic)
+                    return
+
+
+def stream(hub, key, create_poller, keepalive_interval=15):
+    """
+    yields the server sent events of a topic until it ends or the browser goes away.
+    """
+    subscriber = hub.subscribe(key, create_poller)
+    try:
+        last_sent = time()
+        while True:
+            try:
+                message = subscriber.get(timeout=1)
+            except Empty:
+                if time() - last_sent >= keepalive_interval:
+                    last_sent = time()
+                    yield ': keepalive\n\n'
+                continue
+
+            if message is None:
+                return
+            last_sent = time()
+            yield format_event(*message)
+    finally:
+        hub.unsubscribe(key, subscriber)
@@ -1,14 +1,28 @@
+# the gevent workers need ssl, sockets and threads patched before boto3, urllib3 or flask import them,
+# and gunicorn's master imports this module before it forks the workers, see bob.webserver.run.
+if __name__ == "__main__":
+    from bob.webserver.run import patch_gevent
+    patch_gevent()
+
 from flask import Flask, render_template, request, Response, jsonify, redirect
 from gunicorn.app.base import BaseApplication
 from gunicorn.six import iteritems
 import multiprocessing
+import threading
 import traceback
 from dateutil.parser import parse as parse_date
 from functools import wraps
 from bob.common.task import Task
 from bob.common import db
 from bob.common import queues
+from bob.common.submit import submit_task, submit_tasks
+from bob.common.tools import to_json_value
+from bob.common.aws import get_boto3_resource
+from bob.common.log_store import get_log_store, get_log_key, decode_log
 from bob.webserver.settings import load_settings
+from bob.webserver.streams import StreamHub, TaskPoller, TaskListPoller, stream
+from bob.webserver.webhooks import WebhookIngester
+from datetime import datetime
 import hashlib
 import hmac
 import os
@@ -17,6 +31,16 @@ import os
 app = Flask(__name__)
 settings = load_settings()
 
+# the number of newest tasks rendered on the tasks page, the older ones are never read.
+_tasks_view_limit = 500
+# the threads of each worker when gevent is not patched in, and how many of them event streams may hold.
+_worker_threads = 50
+_max_thread_streams = 25
+_stream_slots = None
+
+# one database poll per watched task in each web server process, shared by all its viewers.
+_stream_hub = StreamHub()
+
 if settings and 'basic_auth' in settings:
     app.config['login'] = settings['basic_auth']['login']
     app.config['password'] = settings['basic_auth']['password']
@@ -25,13 +49,62 @@ if settings and 'github_hook' in settings:
     app.config['secret'] = settings['github_hook'].get('secret')
 
 
+def _get_supersede_settings():
+    supersede = (settings.get('supersede') or {}) if settings else {}
+    return supersede.get('pending', True), supersede.get('running', False)
+
+
 def _queue_build(repo, branch='master', tag='latest', created_by=None):
     task = Task(git_repo=repo,
                 git_branch=branch,
                 git_tag=tag,
                 created_by=created_by)
-    db.save_task(task)
-    queues.enqueue_task(task)
+    supersede, cancel_running = _get_supersede_settings()
+    submit_task(task, supersede=supersede, cancel_running=cancel_running)
+
+
+def _submit_webhook_tasks(tasks):
+    supersede, cancel_running = _get_supersede_settings()
+    submit_tasks(tasks, supersede=supersede, cancel_running=cancel_running)
+
+
+def _create_webhook_ingester():
+    hook_settings = (settings.get('github_hook') or {}) if settings else {}
+    return WebhookIngester(_submit_webhook_tasks,
+                           dedupe_seconds=hook_settings.get('dedupe_seconds', 10 * 60),
+                           batch_size=hook_settings.get('batch_size', 25))
+
+
+# web hook builds are saved and queued in batches behind the replies to github.
+_webhook_ingester = _create_webhook_ingester()
+
+_default_push_debounce_seconds = 30
+
+
+def _get_push_debounce_seconds(repo, branch):
+    """
+    returns how long to wait for more pushes before building a pushed branch,
+    None if the repo's pushes are not built. set per repo in webserver-settings.yml e.g.
+        github_hook:
+          push:
+            debounce_seconds: 30
+            repos:
+              metocean/bob-the-builder-example:
+                branches: [master, develop]
+    """
+    hook_settings = (settings.get('github_hook') or {}) if settings else {}
+    push_settings = hook_settings.get('push') or {}
+    repos = push_settings.get('repos') or {}
+    if repo not in repos:
+        return None
+
+    repo_settings = repos[repo] or {}
+    branches = repo_settings.get('branches')
+    if branches and branch not in branches:
+        return None
+
+    return repo_settings.get('debounce_seconds',
+                             push_settings.get('debounce_seconds', _default_push_debounce_seconds))
 
 
 def check_auth(username, password):
@@ -94,7 +167,9 @@ def tasks_view():
             _queue_build(repo=req_data[0], branch=req_data[1], tag=req_data[2], created_by='website')
         return redirect('/')
     else:
-        return render_template('tasks.html', tasks=db.load_all_tasks())
+        # the rows are read from /api/tasks by the page itself.
+        limit = request.args.get('limit', _tasks_view_limit, type=int)
+        return render_template('tasks.html', limit=limit, now=datetime.utcnow().isoformat())
 
 
 @app.route('/task/<owner>/<repo>/<branch>/<tag>/<created_at>', methods=['GET'])
@@ -104,16 +179,160 @@ def task_view(owner, repo, branch, tag, created_at):
     task = db.load_task(git_repo=owner + '/' + repo,
                         git_branch=branch,
                         git_tag=tag,
-                        created_at=parse_date(created_at))
+                        created_at=parse_date(created_at),
+                        cached=True)
 
     if not task:
         return 'Task not found', 404
 
+    not_modified = _not_modified(task)
+    if not_modified:
+        return not_modified
+
     cancel_disabled = 'disabled' if task.is_done() else ''
 
-    return render_template('task.html',
-                           task=task,
-                           cancel_disabled=cancel_disabled)
+    return _conditional(task, render_template('task.html',
+                                              task=task,
+                                              logs=_get_log_tails(task),
+                                              cancel_disabled=cancel_disabled))
+
+
+def _get_etag(task):
+    return '{0}-{1}'.format(task.version, task.modified_at.isoformat())
+
+
+def _not_modified(task):
+    """
+    returns a 304 response if the browser already has this version of the task, before any page is rendered.
+    """
+    response = Response()
+    response.set_etag(_get_etag(task))
+    response.last_modified = task.modified_at
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+    return None
+
+
+def _conditional(task, body, mimetype='text/html'):
+    """
+    returns the body with an ETag and Last-Modified of the task's version, so repeat requests can be 304s.
+    """
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(_get_etag(task))
+    response.last_modified = task.modified_at
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _get_log_tails(task, max_bytes=10 * 1024):
+    """
+    returns a list of (log entry, tail text) for the task's logs.
+    """
+    log_store = get_log_store()
+    logs = []
+    for log in task.logs:
+        if 'chunks' in log:
+            text = decode_log(log_store.tail(get_log_key(task, log['filename']), log['chunks'], max_bytes))
+        else:
+            # logs saved before the log store kept their text in the task.
+            text = log.get('text') or ''
+        logs.append((log, text))
+    return logs
+
+
+@app.route('/task/<owner>/<repo>/<branch>/<tag>/<created_at>/logs/<filename>', methods=['GET'])
+@requires_basic_auth
+def task_log_view(owner, repo, branch, tag, created_at, filename):
+
+    task = db.load_task(git_repo=owner + '/' + repo,
+                        git_branch=branch,
+                        git_tag=tag,
+                        created_at=parse_date(created_at),
+                        cached=True)
+
+    log = task.get_log(filename) if task else None
+    if not log:
+        return 'Log not found', 404
+
+    not_modified = _not_modified(task)
+    if not_modified:
+        return not_modified
+
+    if 'chunks' in log:
+        text = decode_log(get_log_store().read(get_log_key(task, filename), log['chunks']))
+    else:
+        text = log.get('text') or ''
+
+    return _conditional(task, text, mimetype='text/plain')
+
+
+@app.route('/api/tasks', methods=['GET'])
+@requires_basic_auth
+def api_tasks():
+    """
+    one page of tasks as json.
+    query parameters: repo, branch, tag, limit (page size, at most 500), cursor (from the previous page),
+    fields (comma separated task attributes, default the summary fields)
+    and since (an isoformat modified_at, to only get the tasks changed after it, oldest change first).
+    """
+    fields = request.args.get('fields')
+    fields = [field for field in fields.split(',') if field] if fields else db.summary_fields
+    unknown = [field for field in fields if field not in db.task_fields]
+    if unknown:
+        return jsonify(msg='unknown fields: {0}'.format(', '.join(unknown))), 400
+    page_size = min(max(request.args.get('limit', 100, type=int), 1), _tasks_view_limit)
+
+    try:
+        items, cursor = db.list_task_items_page(git_repo=request.args.get('repo'),
+                                                git_branch=request.args.get('branch'),
+                                                git_tag=request.args.get('tag'),
+                                                fields=fields,
+                                                since=request.args.get('since'),
+                                                page_size=page_size,
+                                                cursor=request.args.get('cursor'))
+    except (ValueError, TypeError):
+        return jsonify(msg='invalid cursor'), 400
+
+    return jsonify(tasks=to_json_value(items), cursor=cursor)
+
+
+def _event_stream(key, create_poller):
+    """
+    without gevent each stream holds one of the worker's threads, a stream over _max_thread_streams is refused
+    so the other requests, e.g. github's web hooks, always get a thread. the pages then poll instead.
+    """
+    if _stream_slots is not None and not _stream_slots.acquire(False):
+        return Response('too many open event streams', status=503, headers={'Retry-After': '60'})
+
+    response = Response(stream(_stream_hub, key, create_poller),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if _stream_slots is not None:
+        response.call_on_close(_stream_slots.release)
+    return response
+
+
+@app.route('/task/<owner>/<repo>/<branch>/<tag>/<created_at>/stream', methods=['GET'])
+@requires_basic_auth
+def task_stream(owner, repo, branch, tag, created_at):
+    """
+    server sent events of the task: 'state' on every state change, 'log' with the text appended to a log,
+    'done' once it has finished. it starts with the current state and the tail of every log.
+    """
+    git_repo = owner + '/' + repo
+    created_at = parse_date(created_at)
+    return _event_stream(('task', git_repo, branch, tag, created_at),
+                         lambda: TaskPoller(git_repo, branch, tag, created_at))
+
+
+@app.route('/api/tasks/stream', methods=['GET'])
+@requires_basic_auth
+def api_tasks_stream():
+    """
+    server sent events of every task: 'task' with the summary of each task as it changes.
+    """
+    return _event_stream(('tasks',), TaskListPoller)
 
 
 def _verify_hmac_hash(request_body, supplied_signature, secret):
@@ -135,7 +354,7 @@ def _verify_hmac_hash(request_body, supplied_signature, secret):
 
 @app.route("/github_webhook", methods=['POST'])
 def github_payload():
-    # delivery = request.headers.get('X-GitHub-Delivery')
+    delivery = request.headers.get('X-GitHub-Delivery')
     event_type = request.headers.get('X-GitHub-Event')
     signature = request.headers.get('X-Hub-Signature')
     secret = app.config.get('secret')
@@ -173,11 +392,49 @@ def github_payload():
         if 'author' in data['release'] and 'login' in data['release']['author']:
             created_by += ' - {0}'.format(data['release']['author']['login'])
 
-        _queue_build(repo=repo, branch=branch, tag=tag, created_by=created_by)
+        task = Task(git_repo=repo,
+                    git_branch=branch,
+                    git_tag=tag,
+                    created_by=created_by)
+        return _accept_webhook_build(delivery, task)
+
+    if event_type.lower() == "push":
+        data = request.get_json()
+
+        if not ('repository' in data and 'full_name' in data['repository']):
+            return jsonify({'msg': 'Ok'})
+
+        # tags are built from their releases, and a deleted branch has nothing to build.
+        ref = data.get('ref') or ''
+        if not ref.startswith('refs/heads/') or data.get('deleted') or not data.get('after'):
+            return jsonify({'msg': 'Ok'})
+
+        repo = data['repository']['full_name']
+        branch = ref[len('refs/heads/'):]
+        debounce_seconds = _get_push_debounce_seconds(repo, branch)
+        if debounce_seconds is None:
+            return jsonify({'msg': 'Ok'})
+
+        created_by = 'github push'
+        if 'pusher' in data and 'name' in data['pusher']:
+            created_by += ' - {0}'.format(data['pusher']['name'])
+
+        task = Task(git_repo=repo,
+                    git_branch=branch,
+                    created_by=created_by,
+                    requested_sha=data['after'])
+        return _accept_webhook_build(delivery, task, debounce_seconds=debounce_seconds)
 
     return jsonify({'msg': 'Ok'})
 
 
+def _accept_webhook_build(delivery, task, debounce_seconds=None):
+    result = _webhook_ingester.accept(delivery, task, debounce_seconds=debounce_seconds)
+    if result == 'busy':
+        return jsonify(msg='too many builds waiting to be queued, redeliver later'), 503
+    return jsonify(msg='Ok', result=result), 202
+
+
 class GunicornApplication(BaseApplication):
 
     def __init__(self, app, options=None):
@@ -195,14 +452,60 @@ class GunicornApplication(BaseApplication):
         return self.application
 
 
+def _post_fork(server, worker):
+    """
+    warms the worker process's own aws connections before it takes requests.
+    """
+    get_boto3_resource('dynamodb')
+    get_boto3_resource('sqs')
+    _webhook_ingester.start()
+
+
+def _worker_exit(server, worker):
+    """
+    lets another worker process have the debounced web hook builds the stopping one holds.
+    """
+    _webhook_ingester.release()
+
+
+def _is_gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def _get_worker_options():
+    """
+    the event streams hold a connection open per viewer, so the workers must be async.
+    gevent is used if it is installed and patched everything before the imports, see bob.webserver.run,
+    otherwise a pool of threads, of which only _max_thread_streams are given to event streams.
+    """
+    global _stream_slots
+    if _is_gevent_patched():
+        _stream_slots = None
+        return {'worker_class': 'gevent', 'worker_connections': 1000}
+
+    print('WARNING: gevent is not installed or was not patched in before the web server was imported, '
+          'start it with bob-web. using {0} threads per worker, at most {1} browsers per worker can follow '
+          'tasks live, the others poll.'.format(_worker_threads, _max_thread_streams))
+    _stream_slots = threading.BoundedSemaphore(_max_thread_streams)
+    return {'worker_class': 'gthread', 'threads': _worker_threads}
+
+
 def main():
     db.create_task_table()
     queues.create_task_queue()
+    queues.create_webhook_queue()
 
     options = {
         'bind': '%s:%s' % ('0.0.0.0', os.environ.get('BOB-BUILDER-PORT', '8080')),
         'workers': multiprocessing.cpu_count(),
+        'post_fork': _post_fork,
+        'worker_exit': _worker_exit,
     }
+    options.update(_get_worker_options())
     GunicornApplication(app, options).run()
 
 
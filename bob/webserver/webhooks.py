@@ -0,0 +1,220 @@
+import threading
+import traceback
+from datetime import datetime
+from time import sleep, time
+
+from bob.common import queues
+from bob.common.cache import create_cache
+
+_default_dedupe_seconds = 10 * 60
+_default_batch_size = 25
+_default_batch_seconds = 0.5
+_default_max_debounced = 10000
+_max_retry_delay = 60
+# a debounced build's message is hidden until it is due, plus this long to save it.
+_debounce_margin_seconds = 60
+_epoch = datetime(1970, 1, 1)
+
+
+class WebhookIngester(object):
+    """
+    takes the builds asked for by web hooks off the request thread: accept() only dedupes the delivery and
+    sends the task to the web hook queue, so github gets its reply straight away, and a background thread in
+    each web server process saves and queues them as tasks in batches. a build is only deleted from the web hook
+    queue once its task is saved, until then a failure, or a web server process that stops, leaves it to be
+    received again.
+
+    a delivery is a duplicate if its delivery id, or the repo, branch and tag it builds,
+    was accepted in the last dedupe_seconds. with a redis task_cache this holds across every web server process.
+
+    a debounced build, e.g. of a push, is held for debounce_seconds from when it was accepted and replaced by any
+    later one of the same repo, branch and tag, so a burst of pushes is built once at its newest commit.
+    """
+
+    def __init__(self,
+                 submit,
+                 dedupe_seconds=_default_dedupe_seconds,
+                 batch_size=_default_batch_size,
+                 batch_seconds=_default_batch_seconds,
+                 max_debounced=_default_max_debounced):
+        """
+        :param submit: called with each batch of tasks to save and queue them.
+        """
+        self.submit = submit
+        self.dedupe_seconds = dedupe_seconds
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.max_debounced = max_debounced
+        # (repo, branch, tag) to [due time, task, messages] of the debounced builds this process holds.
+        self.debounced = {}
+        self.seen = create_cache(max_entries=max_debounced * 10)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _dedupe_keys(self, delivery_id, task):
+        keys = []
+        if delivery_id:
+            keys.append('webhook:delivery:{0}'.format(delivery_id))
+        keys.append('webhook:build:{0}:{1}:{2}'.format(task.git_repo, task.git_branch, task.git_tag))
+        return keys
+
+    def _forget(self, keys):
+        for key in keys:
+            try:
+                self.seen.delete(key)
+            except Exception as ex:
+                print('webhook dedupe delete failed: {0}'.format(ex))
+
+    def _add_seen(self, keys):
+        """
+        marks the keys seen, returns False without marking any if one already was.
+        """
+        added = []
+        for key in keys:
+            try:
+                is_new = self.seen.add(key, '1', self.dedupe_seconds)
+            except Exception as ex:
+                # better a duplicate build than a lost one.
+                print('webhook dedupe check failed: {0}'.format(ex))
+                is_new = True
+            if not is_new:
+                self._forget(added)
+                return False
+            added.append(key)
+        return True
+
+    def accept(self, delivery_id, task, debounce_seconds=None):
+        """
+        :param debounce_seconds: hold the build this long for a later one to replace it,
+                                 only the delivery id is then deduped.
+        :return: 'queued', 'debounced', 'duplicate' or 'busy' when the build could not be queued,
+                 github then records the delivery as failed so it can be redelivered.
+        """
+        keys = self._dedupe_keys(delivery_id, task)
+        if debounce_seconds is not None:
+            keys = keys[:-1]
+        if not self._add_seen(keys):
+            return 'duplicate'
+
+        try:
+            queues.send_webhook_build(task, debounce_seconds)
+        except Exception as ex:
+            print('failed to queue a web hook build: {0}'.format(ex))
+            self._forget(keys)
+            return 'busy'
+
+        self.start()
+        return 'queued' if debounce_seconds is None else 'debounced'
+
+    def start(self):
+        """
+        starts receiving the web hook builds, in each gunicorn worker process and not the master it forked from.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _hold(self, task, debounce_seconds, message):
+        """
+        keeps the newest debounced build of each repo, branch and tag, and every message it replaced,
+        so all of them are deleted once it is saved. returns False if too many are held already.
+        """
+        build = (task.git_repo, task.git_branch, task.git_tag)
+        with self.lock:
+            held = self.debounced.get(build)
+            if held:
+                due_at = held[0]
+                if task.created_at > held[1].created_at:
+                    held[1] = task
+                held[2].append(message)
+            elif len(self.debounced) >= self.max_debounced:
+                return False
+            else:
+                # the window runs from the first push, so a steady stream of pushes still gets built.
+                due_at = (task.created_at - _epoch).total_seconds() + debounce_seconds
+                self.debounced[build] = [due_at, task, [message]]
+        due_in = max(0, due_at - time())
+
+        queues.change_visibility([message], int(due_in) + _debounce_margin_seconds)
+        return True
+
+    def _take_due(self, take_all=False):
+        """
+        returns the (task, messages) of the debounced builds whose window has passed.
+        """
+        now = time()
+        due = []
+        with self.lock:
+            for build, (due_at, task, messages) in list(self.debounced.items()):
+                if take_all or due_at <= now:
+                    del self.debounced[build]
+                    due.append((task, messages))
+        return due
+
+    def _receive(self, wait_seconds):
+        """
+        returns the (task, messages) of the builds to save now, holding the debounced ones until they are due.
+        """
+        batch = []
+        for task, debounce_seconds, message in queues.receive_webhook_builds(min(10, self.batch_size),
+                                                                             wait_seconds):
+            if debounce_seconds is None:
+                batch.append((task, [message]))
+            elif not self._hold(task, debounce_seconds, message):
+                # leave it for another web server process.
+                queues.change_visibility([message], 0)
+        return batch
+
+    def _wait_seconds(self):
+        with self.lock:
+            if not self.debounced:
+                return 20
+            return max(0, min(20, int(min(due_at for due_at, _, _ in self.debounced.values()) - time())))
+
+    def _next_batch(self):
+        """
+        waits for a build or a debounced build to be due, then gathers the ones that follow it for up to
+        batch_seconds.
+        """
+        batch = self._take_due()
+        while not batch:
+            batch = self._receive(self._wait_seconds()) + self._take_due()
+
+        deadline = time() + self.batch_seconds
+        while len(batch) < self.batch_size and time() < deadline:
+            more = self._receive(1) + self._take_due()
+            if not more:
+                break
+            batch += more
+        return batch
+
+    def _submit_batch(self, batch):
+        """
+        saves and queues the batch's tasks, then deletes their messages.
+        raises if they could not be saved, their messages are then received again once they are visible.
+        """
+        self.submit([task for task, messages in batch])
+        queues.delete_messages([message for task, messages in batch for message in messages])
+        print('queued {0} web hook builds'.format(len(batch)))
+
+    def _run(self):
+        failures = 0
+        while True:
+            try:
+                self._submit_batch(self._next_batch())
+                failures = 0
+            except Exception as ex:
+                failures += 1
+                print('failed to queue web hook builds, they will be received again: {0}'.format(ex))
+                traceback.print_exc()
+                sleep(min(2 ** failures, _max_retry_delay))
+
+    def release(self):
+        """
+        lets another web server process have the debounced builds this one holds, for when it is stopping.
+        """
+        messages = [message for task, messages in self._take_due(take_all=True) for message in messages]
+        if messages:
+            queues.change_visibility(messages, 0)
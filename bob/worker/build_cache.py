@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+
+import bob.common.db as db
+
+# builds asked to ignore the docker cache must really build.
+_uncacheable_build_args = ('--no-cache', '--pull')
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                sha.update(block)
+    except (IOError, OSError):
+        return None
+    return sha.hexdigest()
+
+
+def get_cache_key(task, source_path, docker_compose_file):
+    """
+    returns the key of the build's result: the commit, the build args, the compose file and bob-the-builder.yml.
+    returns None if the build must not be cached.
+    """
+    if not task.git_sha:
+        return None
+
+    for arg in task.build_args:
+        if arg in _uncacheable_build_args:
+            return None
+
+    inputs = {
+        'git_repo': task.git_repo,
+        'git_sha': task.git_sha,
+        'build_args': task.build_args,
+        'docker_compose': _hash_file(os.path.join(source_path, docker_compose_file)),
+        'bob_the_builder': _hash_file(os.path.join(source_path, 'bob-the-builder.yml'))
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def find_cached_images(cache_key):
+    """
+    returns the images a previous build of the same inputs pushed,
+    a dictionary of services_to_push image names to the 'image@digest' pushed, None on a cache miss.
+    """
+    if not cache_key:
+        return None
+    result = db.load_build_result(cache_key)
+    if not result or not result.get('images'):
+        return None
+
+    # a tag may have been pushed again since, only a digest is sure to be this build's image.
+    images = result['images']
+    if not all('@' in image for image in images.values()):
+        return None
+    return images
+
+
+def save_pushed_images(task, pushed_images):
+    """
+    :param pushed_images: as returned from bob.worker.builder.do_push_dockers()
+    """
+    if not task.build_cache_key or not pushed_images:
+        return
+
+    digests = dict((image_name, pushed.get('digest')) for image_name, pushed in pushed_images.items())
+    if not all(digests.values()):
+        print('not caching the build, the digests of its pushed images are not all known')
+        return
+    db.save_build_result(task.build_cache_key, task, digests)
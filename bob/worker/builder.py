@@ -1,33 +1,47 @@
 import yaml
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
 from shutil import rmtree
 import json
 
 from bob.common.exceptions import BobTheBuilderException
 from bob.worker.settings import load_settings
-from bob.worker.docker_client import get_recent_images
-from bob.worker.git_hub import download_tag_source, download_branch_source
+from bob.worker.docker_client import get_docker_client, find_build_images, remove_project_networks
+from bob.worker.docker_cache import touch_project_images, remove_project_containers
+from bob.worker.git_hub import download_tag_source, download_branch_source, checkout_mirror_source
+from bob.worker.git_mirror import get_git_mirror_cache
+from bob.worker.compose import get_build_graph, load_compose_services
+from bob.worker.registry import RegistryClient, split_image_name, get_config_digest, is_docker_hub
 from bob.worker.tools import (execute,
-                              execute_with_logging,
-                              rename_basedir,
-                              base_dirname)
+                              execute_with_logging)
 import bob.common.db as db
+from bob.common.log_store import get_log_store, get_log_key
+
+
+_task_lock = threading.RLock()
 
 
 def _get_build_log(build_path):
     return os.path.join(build_path, 'docker-build.log')
 
 
+def _get_service_build_log(build_path, service_name):
+    return os.path.join(build_path, 'docker-build-{0}.log'.format(service_name))
+
+
 def _get_image_matching_log(build_path):
     return os.path.join(build_path, 'image-matching.log')
 
 
-def _get_tag_log(build_path):
-    return os.path.join(build_path, 'docker-tag.log')
+def _get_image_push_log(build_path, docker_hub_image, docker_hub_tag):
+    name = '{0}-{1}'.format(docker_hub_image, docker_hub_tag).replace('/', '_').replace(':', '_')
+    return os.path.join(build_path, 'docker-push-{0}.log'.format(name))
 
 
-def _get_push_log(build_path):
-    return os.path.join(build_path, 'docker-push.log')
+def _get_retry_log(build_path):
+    return os.path.join(build_path, 'retries.log')
 
 
 def _get_test_log(build_path):
@@ -46,13 +60,61 @@ def _get_git_release_log(build_path):
     return os.path.join(build_path, 'git-release.json')
 
 
-def _write_log_to_db(text, log_path, task):
-    if not text or len(text) == 0:
+def _get_log_position(task, filename):
+    """
+    returns the (size, chunks) the log store holds for the task's log file.
+    """
+    entry = task.get_log(filename)
+    if not entry:
+        return 0, 0
+    return entry.get('size', 0), entry.get('chunks', 0)
+
+
+def _append_log(task, log_path, data, size, chunks, insert_first=False):
+    filename = os.path.basename(log_path)
+    chunks = get_log_store().append(get_log_key(task, filename), chunks, data)
+    db.save_task_log(task, task.set_log(log_path, size + len(data), chunks, insert_first=insert_first))
+
+
+def save_log_file(task, log_path, insert_first=False, rewrite=False):
+    """
+    appends the part of the log file the log store does not have yet as a new chunk,
+    then points the task's log entry at it.
+    :param rewrite: the caller truncated or created the log file, e.g. opened it with 'w',
+                    the store's copy is then replaced by the whole file.
+    """
+    if rewrite:
+        size, chunks = 0, 0
+    else:
+        with _task_lock:
+            size, chunks = _get_log_position(task, os.path.basename(log_path))
+
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(size)
+            data = f.read()
+    except (IOError, OSError):
+        return
+
+    if not data:
+        return
+
+    with _task_lock:
+        _append_log(task, log_path, data, size, chunks, insert_first=insert_first)
+
+
+def _write_log_to_db(data, log_path, task):
+    """
+    the execute_with_logging() callback, appends the new output as a chunk in the log store.
+    """
+    if not data or len(data) == 0:
         return
     if task is None:
         return
-    task.save_log(text, log_path)
-    db.save_task(task)
+    # images are pushed from several threads, they share the task's log entries and version.
+    with _task_lock:
+        size, chunks = _get_log_position(task, os.path.basename(log_path))
+        _append_log(task, log_path, data, size, chunks)
 
 
 def _write_log_file_and_db(text, log_path, task):
@@ -62,27 +124,70 @@ def _write_log_file_and_db(text, log_path, task):
         return
     with open(log_path, 'w') as f:
         f.write(text)
-    task.save_log(text, log_path)
-    db.save_task(task)
+    save_log_file(task, log_path, rewrite=True)
+
+
+def _append_log_file_and_db(text, log_path, task):
+    """
+    adds a line to a log several push threads share.
+    """
+    print(text)
+    with _task_lock:
+        with open(log_path, 'a') as f:
+            f.write(text + '\n')
+        save_log_file(task, log_path)
+
+
+def log_retry(task, build_path, text):
+    _append_log_file_and_db('{0} {1}'.format(datetime.utcnow().isoformat(), text), _get_retry_log(build_path), task)
 
 
 def do_download_git_repo(task, build_path, created_at_str):
     print('do_download_git_repo')
 
     settings = load_settings()
+    tag_name = task.git_tag if task.git_tag and task.git_tag != 'latest' else None
+
+    # a retried download starts from a clean directory.
+    rmtree(os.path.join(build_path, 'src', created_at_str), ignore_errors=True)
+
+    source_path = None
+    mirror_cache = get_git_mirror_cache(settings)
+    if mirror_cache:
+        try:
+            source_path, task.git_sha = checkout_mirror_source(mirror_cache,
+                                                 task.git_repo,
+                                                 build_path,
+                                                 created_at_str,
+                                                 branch=task.git_branch,
+                                                 tag_name=tag_name,
+                                                 login=settings['git_hub']['login'],
+                                                 password=settings['git_hub']['password'],
+                                                 sha=task.requested_sha)
+        except Exception as ex:
+            print('git mirror checkout failed, downloading the tarball instead: {0}'.format(ex))
+            rmtree(os.path.join(build_path, 'src', created_at_str), ignore_errors=True)
+
+        try:
+            mirror_cache.evict()
+        except Exception as ex:
+            print('git mirror eviction failed: {0}'.format(ex))
 
-    if task.git_tag and task.git_tag != 'latest':
-        source_path = download_tag_source(task.git_repo,
+    if not source_path and tag_name:
+        source_path, task.git_sha = download_tag_source(task.git_repo,
                                           task.git_tag,
                                           build_path,
                                           settings['git_hub']['login'],
-                                          settings['git_hub']['password'])
-    else:
-        source_path = download_branch_source(task.git_repo,
+                                          settings['git_hub']['password'],
+                                          dirname=created_at_str)
+    elif not source_path:
+        source_path, task.git_sha = download_branch_source(task.git_repo,
                                              build_path,
                                              task.git_branch,
                                              settings['git_hub']['login'],
-                                             settings['git_hub']['password'])
+                                             settings['git_hub']['password'],
+                                             dirname=created_at_str,
+                                             sha=task.requested_sha)
 
     with open(os.path.join(source_path, 'bob-the-builder.yml'), 'r') as f:
         build = yaml.load(f)
@@ -98,80 +203,433 @@ def do_download_git_repo(task, build_path, created_at_str):
         test_service = build['docker_compose'].get('test_service')
         notification_emails = build.get('notification_emails', [])
 
-    return (rename_basedir(source_path, created_at_str),
+    return (source_path,
             docker_compose_file,
             services_to_push,
             test_service,
             notification_emails)
 
 
-def do_build_dockers(task, build_path, source_path, docker_compose_file):
+def _compose_cmd(docker_compose_file, compose_project):
+    """
+    every build uses its own compose project, so builds running side by side
+    get their own image, container and network names.
+    """
+    return 'docker-compose -f {0} -p {1}'.format(docker_compose_file, compose_project)
+
+
+def _build_service(task, build_path, docker_compose_file, compose_project, service_name):
+    """
+    builds one service into its own docker-build-<service>.log and records how long it took on the task.
+    """
+    cmd = '{0} build {1} {2}'.format(_compose_cmd(docker_compose_file, compose_project),
+                                     ' '.join(task.build_args),
+                                     service_name)
+    started_at = datetime.utcnow()
+    result = 'failed'
+    try:
+        execute_with_logging(cmd,
+                             log_filename=_get_service_build_log(build_path, service_name),
+                             log_callback=_write_log_to_db,
+                             log_callback_obj=task)
+        result = 'successful'
+    finally:
+        with _task_lock:
+            task.add_timing('build {0}'.format(service_name), started_at, datetime.utcnow(), result)
+            db.save_task_attributes(task, ('timings',))
+
+
+def _build_services_in_parallel(task, build_path, docker_compose_file, compose_project, graph, build_concurrency):
+    """
+    builds every service once the services it builds FROM are built, up to build_concurrency at once.
+    once a service fails no more are started, the running ones are left to finish.
+    """
+    remaining = dict(graph)
+    built = set()
+    failures = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=build_concurrency) as executor:
+        while remaining or running:
+            if not failures:
+                for service_name in sorted(remaining):
+                    if len(running) >= build_concurrency:
+                        break
+                    if remaining[service_name] <= built:
+                        del remaining[service_name]
+                        future = executor.submit(_build_service,
+                                                 task,
+                                                 build_path,
+                                                 docker_compose_file,
+                                                 compose_project,
+                                                 service_name)
+                        running[future] = service_name
+
+            if not running:
+                if remaining and not failures:
+                    failures.append('the services build FROM each other: {0}'.format(', '.join(sorted(remaining))))
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                service_name = running.pop(future)
+                try:
+                    future.result()
+                    built.add(service_name)
+                except Exception as ex:
+                    failures.append('{0}: {1}'.format(service_name, ex))
+
+    if failures:
+        raise BobTheBuilderException('building services failed:\r\n{0}'.format('\r\n'.join(failures)))
+
+
+def do_build_dockers(task, build_path, source_path, docker_compose_file, compose_project):
+    """
+    builds the compose project's images with one docker-compose build,
+    or with 'build_concurrency' (worker-settings.yml) above 1 builds services side by side
+    in the order the dockerfiles FROM each other, see bob.worker.compose.get_build_graph()
+    a build whose args name the services to build is always built in one go, as asked.
+    """
     print('do_build_dockers')
     os.chdir(source_path)
 
+    build_concurrency = int(load_settings().get('build_concurrency', 1))
+    if build_concurrency > 1:
+        try:
+            graph = get_build_graph(source_path, docker_compose_file)
+            services = load_compose_services(source_path, docker_compose_file)
+            named_services = [arg for arg in task.build_args if arg in services]
+        except Exception as ex:
+            print('could not read the build order from {0}, building in one go: {1}'.format(docker_compose_file, ex))
+            graph = None
+            named_services = []
+
+        if named_services:
+            print('building the services named by the build args in one go: {0}'.format(', '.join(named_services)))
+            graph = None
+
+        if graph and len(graph) > 1:
+            _write_log_file_and_db('building services in this order, each after the services it builds FROM:\n{0}'
+                                   .format(json.dumps(dict((name, sorted(graph[name])) for name in graph),
+                                                      indent=2, sort_keys=True)),
+                                   _get_build_log(build_path),
+                                   task)
+            _build_services_in_parallel(task,
+                                        build_path,
+                                        docker_compose_file,
+                                        compose_project,
+                                        graph,
+                                        build_concurrency)
+            return
+
     if len(task.build_args) == 0:
-        cmd = 'docker-compose -f {0} build '.format(docker_compose_file)
+        cmd = '{0} build '.format(_compose_cmd(docker_compose_file, compose_project))
     else:
-        cmd = 'docker-compose -f {0} build '.format(docker_compose_file) + ' '.join(task.build_args)
+        cmd = '{0} build '.format(_compose_cmd(docker_compose_file, compose_project)) + ' '.join(task.build_args)
 
     execute_with_logging(cmd,
                          log_filename=_get_build_log(build_path),
-                         tail_callback=_write_log_to_db,
-                         tail_callback_obj=task)
+                         log_callback=_write_log_to_db,
+                         log_callback_obj=task)
 
 
-def do_test_dockers(task, build_path, source_path, docker_compose_file, service_to_test):
+def do_test_dockers(task, build_path, source_path, docker_compose_file, compose_project, service_to_test):
     print('do_test_dockers')
     os.chdir(source_path)
 
-    execute_with_logging('docker-compose -f {0} run {1}'.format(docker_compose_file, service_to_test),
+    execute_with_logging('{0} run {1}'.format(_compose_cmd(docker_compose_file, compose_project), service_to_test),
                          log_filename=_get_test_log(build_path),
-                         tail_callback=_write_log_to_db,
-                         tail_callback_obj=task)
+                         log_callback=_write_log_to_db,
+                         log_callback_obj=task)
 
 
-def _map_services_to_images(source_path, services_to_push, local_images):
+def _split_image_tag(image_name):
     """
-    :param source_path: the source directory path to where the docker-compose.yml lives.
-    :param services_to_push: a dictionary of docker_compose services mapping the docker hub push image name.
-    :return: a dictionary of local image names to docker hub image names.
+    returns the (name, tag) of an image name, the tag defaults to latest.
     """
-    src_dirname = base_dirname(source_path)
-    images = {}
+    if ':' in image_name.rsplit('/', 1)[-1]:
+        return tuple(image_name.rsplit(':', 1))
+    return image_name, 'latest'
+
+
+def _index_images(compose_project, local_images):
+    """
+    returns two lookup tables of the local images:
+    (compose project, service name) to the images docker compose built for the service,
+    and 'name:tag' to the images tagged with it.
+    """
+    by_service = {}
+    by_name = {}
     for image in local_images:
-        for repo_tag_name in image['RepoTags']:
-            # if service name is used in bob-the-build.yml
-            if repo_tag_name.startswith(src_dirname):
-                for service_name in services_to_push:
-                    docker_hub_name = services_to_push[service_name]
-                    if ':' in repo_tag_name:
-                        repo_tag_name = repo_tag_name.split(':', 1)[0]
-                    if repo_tag_name.endswith(service_name):
-                        images[docker_hub_name] = image['Id']
-
-            # else image name is used in bob-the-build.yml
-            else:
-                for image_name in services_to_push:
-                    docker_hub_name = services_to_push[image_name]
-                    if ':' not in image_name:
-                        image_name += ':latest'
-                    if repo_tag_name == image_name:
-                        images[docker_hub_name] = image['Id']
+        labels = image.get('Labels') or {}
+        if labels.get('com.docker.compose.project') == compose_project and 'com.docker.compose.service' in labels:
+            by_service.setdefault((compose_project, labels['com.docker.compose.service']), []).append(image)
+
+        for repo_tag_name in image.get('RepoTags') or []:
+            if not repo_tag_name or repo_tag_name == '<none>:<none>':
+                continue
+            by_name.setdefault(repo_tag_name, []).append(image)
+
+            name, _ = _split_image_tag(repo_tag_name)
+            for separator in ('_', '-'):
+                prefix = compose_project + separator
+                if name.startswith(prefix):
+                    key = (compose_project, name[len(prefix):])
+                    if image not in by_service.get(key, []):
+                        by_service.setdefault(key, []).append(image)
+    return by_service, by_name
+
+
+def _newest_image(images):
+    """
+    picks one of several matching images the same way every time: the newest, then the highest id.
+    """
+    return max(images, key=lambda image: (image.get('Created') or 0, image['Id']))
+
+
+def _map_services_to_images(compose_project, services_to_push, local_images):
+    """
+    :param compose_project: the docker compose project name the images were built under.
+    :param services_to_push: a dictionary of docker_compose services, or image names, mapping the docker hub push
+                             image name.
+    :param local_images: the candidate images, see bob.worker.docker_client.find_build_images()
+    :return: a dictionary of docker hub image names to local image ids.
+    """
+    by_service, by_name = _index_images(compose_project, local_images)
+
+    images = {}
+    for service_name in services_to_push:
+        docker_hub_name = services_to_push[service_name]
+
+        # if service name is used in bob-the-build.yml
+        candidates = by_service.get((compose_project, service_name))
+
+        # else image name is used in bob-the-build.yml
+        if not candidates:
+            candidates = by_name.get('{0}:{1}'.format(*_split_image_tag(service_name)))
+
+        if candidates:
+            images[docker_hub_name] = _newest_image(candidates)['Id']
     return images
 
 
-def do_push_dockers(task, build_path, source_path, services_to_push):
-    print('do_push_dockers')
+def _get_push_tag(task):
+    if task.git_tag and len(task.git_tag) and task.git_tag != 'latest':
+        tag = task.git_tag
+    else:
+        tag = task.git_branch
+
+    if tag == 'master':
+        tag = 'latest'
+    return tag
+
+
+def _get_push_target(docker_hub_image, tag):
+    """
+    returns the (docker hub image, docker hub tag) a services_to_push image name is pushed to.
+    """
+    docker_hub_tag = tag
+
+    #dirty dirty prefix hack for Tom.D!
+    if ':' in docker_hub_image:
+        if docker_hub_tag == 'latest' or not docker_hub_tag or len(docker_hub_tag) == 0:
+            value = docker_hub_image
+        else:
+            value = docker_hub_image + '-' + docker_hub_tag
+        value = value.split(':', 1)
+        docker_hub_image = value[0]
+        docker_hub_tag = value[1]
+
+    return docker_hub_image, docker_hub_tag
+
+
+def _match_images_to_push(task, build_path, compose_project, services_to_push, cached_images):
+    """
+    returns a dictionary of services_to_push image names to the local image to push.
+    """
+    if cached_images:
+        msg = 'reusing the images pushed by a build of the same commit:\n{0}'.format(
+            json.dumps(cached_images, indent=2))
+        print(msg)
+        _write_log_file_and_db(msg, _get_image_matching_log(build_path), task)
+        return dict(cached_images)
 
     local_images = []
-    for image in get_recent_images():
-        local_images.append({'Id': image['Id'], 'RepoTags': image['RepoTags']})
-    images_to_push = _map_services_to_images(source_path, services_to_push, local_images)
+    for image in find_build_images(compose_project, list(services_to_push)):
+        local_images.append({'Id': image['Id'],
+                             'RepoTags': image.get('RepoTags'),
+                             'Created': image.get('Created'),
+                             'Labels': image.get('Labels')})
+    images_to_push = _map_services_to_images(compose_project, services_to_push, local_images)
 
     msg = 'local images found:\n{0}'.format(json.dumps(local_images, indent=2))
     msg += '\n\nimages matched for push:\n{0}'.format(json.dumps(images_to_push, indent=2))
     print(msg)
     _write_log_file_and_db(msg, _get_image_matching_log(build_path), task)
+    return images_to_push
+
+
+def match_built_images(task, build_path, compose_project, services_to_push):
+    """
+    returns a dictionary of services_to_push image names to the ids of the images the build made,
+    these are what do_push_dockers() pushes and are checkpointed so a resumed build can skip building.
+    """
+    return _match_images_to_push(task, build_path, compose_project, services_to_push, None)
+
+
+def _get_registry_client(docker_hub_image, settings):
+    docker_hub = settings.get('docker_hub') or {}
+    # the docker hub login is only sent to docker hub.
+    if not is_docker_hub(docker_hub_image):
+        return RegistryClient(docker_hub_image)
+    return RegistryClient(docker_hub_image, docker_hub.get('login'), docker_hub.get('password'))
+
+
+def _inspect_local_image(local_image_name):
+    """
+    returns the (id, repo digests) of a local image, (None, []) if it is not on this worker.
+    """
+    try:
+        image = get_docker_client().inspect_image(local_image_name)
+    except Exception:
+        return None, []
+    return image.get('Id'), image.get('RepoDigests') or []
+
+
+def _find_source_manifest(client, local_image_name, repo_digests):
+    """
+    returns the (digest, manifest) of the local image already in the target repository under another tag,
+    None if it would have to be pushed. only digests are looked up, a tag may have moved to another image.
+    """
+    # a build cache hit's image is the 'image@digest' an earlier build pushed.
+    repo_digests = list(repo_digests)
+    if '@' in local_image_name:
+        repo_digests.append(local_image_name)
+
+    references = []
+    for repo_digest in repo_digests:
+        name, digest = repo_digest.split('@', 1)
+        if split_image_name(name) == (client.host, client.repository) and digest not in references:
+            references.append(digest)
+
+    for reference in references:
+        manifest = client.get_manifest(reference)
+        if manifest:
+            return reference, manifest
+    return None
+
+
+def _skip_unchanged_push(task, build_path, settings, local_image_name, docker_hub_image, docker_hub_tag):
+    """
+    compares the local image with what the registry holds for docker_hub_image:docker_hub_tag.
+    returns the 'image@digest' the tag points at if the push is not needed, the tag is moved on the registry
+    if it must be. returns None to push, any problem talking to the registry falls back to a normal push.
+    """
+    if not settings.get('skip_unchanged_pushes', True):
+        return None
+
+    target = '{0}:{1}'.format(docker_hub_image, docker_hub_tag)
+    log_path = _get_image_matching_log(build_path)
+    try:
+        client = _get_registry_client(docker_hub_image, settings)
+        image_id, repo_digests = _inspect_local_image(local_image_name)
+
+        remote = client.get_manifest(docker_hub_tag)
+        if remote:
+            remote_digest, content_type, body = remote
+            if (image_id and image_id == get_config_digest(content_type, body)) or \
+                    '{0}@{1}'.format(docker_hub_image, remote_digest) in repo_digests:
+                _append_log_file_and_db('{0} is unchanged ({1}), skipping push'.format(target, remote_digest),
+                                        log_path, task)
+                return '{0}@{1}'.format(docker_hub_image, remote_digest)
+
+        source = _find_source_manifest(client, local_image_name, repo_digests)
+        if source:
+            reference, (digest, content_type, body) = source
+            client.put_manifest(docker_hub_tag, content_type, body)
+            _append_log_file_and_db('{0} is already in the registry as {1} ({2}), moved the tag without pushing'
+                                    .format(target, reference, digest), log_path, task)
+            return '{0}@{1}'.format(docker_hub_image, digest)
+
+        _append_log_file_and_db('{0} {1}, pushing'.format(
+            target, 'differs from the registry' if remote else 'is not in the registry'), log_path, task)
+    except Exception as ex:
+        _append_log_file_and_db('{0} could not be compared with the registry, pushing: {1}'.format(target, ex),
+                                log_path, task)
+    return None
+
+
+def _get_pushed_digest(docker_hub_image, docker_hub_tag):
+    """
+    returns the 'image@digest' docker recorded for the image it pushed as docker_hub_image:docker_hub_tag.
+    """
+    _, repo_digests = _inspect_local_image('{0}:{1}'.format(docker_hub_image, docker_hub_tag))
+    for repo_digest in repo_digests:
+        if split_image_name(repo_digest.split('@', 1)[0]) == split_image_name(docker_hub_image):
+            return repo_digest
+    return None
+
+
+def _push_image(task, build_path, settings, local_image_name, docker_hub_image, docker_hub_tag, pull=False):
+    """
+    tags and pushes one image, logging to its own docker-push-<image>.log
+    nothing is pushed if the registry already has the image under the tag, see _skip_unchanged_push().
+    :param pull: pull local_image_name first, it may have been evicted from this worker or built on another.
+    :return: the 'image@digest' pushed, which unlike the tag always names this image. None if docker did not say.
+    """
+    digest = _skip_unchanged_push(task, build_path, settings, local_image_name, docker_hub_image, docker_hub_tag)
+    if digest:
+        return digest
+
+    log_path = _get_image_push_log(build_path, docker_hub_image, docker_hub_tag)
+
+    if pull:
+        execute_with_logging(
+            'docker pull {0}'.format(local_image_name),
+            log_filename=log_path,
+            log_callback=_write_log_to_db,
+            log_callback_obj=task)
+
+    execute_with_logging(
+        'docker tag {0} {1}:{2}'.format(local_image_name, docker_hub_image, docker_hub_tag),
+        log_filename=log_path,
+        log_callback=_write_log_to_db,
+        log_callback_obj=task)
+
+    execute_with_logging(
+        'docker push {0}:{1}'.format(docker_hub_image, docker_hub_tag),
+        log_filename=log_path,
+        log_callback=_write_log_to_db,
+        log_callback_obj=task)
+
+    return _get_pushed_digest(docker_hub_image, docker_hub_tag)
+
+
+def do_push_dockers(task,
+                    build_path,
+                    compose_project,
+                    services_to_push,
+                    cached_images=None,
+                    images_to_push=None,
+                    pushed_images=None):
+    """
+    tags and pushes the build's images to docker hub, up to 'push_concurrency' (worker-settings.yml) at once.
+    every image is pushed even when one fails, the failures are reported together.
+    :param cached_images: the images of a build cache hit, see bob.worker.build_cache.find_cached_images(),
+                          they are pulled by digest, re-tagged and pushed under this task's tag.
+    :param images_to_push: the images match_built_images() found, they are looked up again if not given.
+    :param pushed_images: the images already pushed, these are skipped and each image pushed is added,
+                          so after a failure it holds the pushes that did complete.
+    :return: a dictionary of services_to_push image names to {'name': 'image:tag', 'digest': 'image@digest'} pushed.
+    """
+    print('do_push_dockers')
+
+    if pushed_images is None:
+        pushed_images = {}
+
+    if cached_images:
+        images_to_push = _match_images_to_push(task, build_path, compose_project, services_to_push, cached_images)
+    elif not images_to_push:
+        images_to_push = match_built_images(task, build_path, compose_project, services_to_push)
 
     if not images_to_push and len(images_to_push) == 0:
         raise BobTheBuilderException(
@@ -183,58 +641,73 @@ def do_push_dockers(task, build_path, source_path, services_to_push):
         execute('docker login -u {login} -p {password}'.format(login=settings['docker_hub']['login'],
                                                                password=settings['docker_hub']['password']))
 
-    if task.git_tag and len(task.git_tag) and task.git_tag != 'latest':
-        tag = task.git_tag
-    else:
-        tag = task.git_branch
-
-    if tag == 'master':
-        tag = 'latest'
-
-    for docker_hub_image in images_to_push:
-        local_image_name = images_to_push[docker_hub_image]
-        docker_hub_tag = tag
-
-        #dirty dirty prefix hack for Tom.D!
-        if ':' in docker_hub_image:
-            if docker_hub_tag == 'latest' or not docker_hub_tag or len(docker_hub_tag) == 0:
-                value = docker_hub_image
-            else:
-                value = docker_hub_image + '-' + docker_hub_tag
-            value = value.split(':', 1)
-            docker_hub_image = value[0]
-            docker_hub_tag = value[1]
-
-        print('pushing docker image: {0} {1}:{2}'.format(local_image_name, docker_hub_image, docker_hub_tag))
+    tag = _get_push_tag(task)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=int(settings.get('push_concurrency', 4))) as executor:
+        for image_name in images_to_push:
+            local_image_name = images_to_push[image_name]
+            docker_hub_image, docker_hub_tag = _get_push_target(image_name, tag)
+
+            pushed_name = '{0}:{1}'.format(docker_hub_image, docker_hub_tag)
+            pushed = pushed_images.get(image_name)
+            if isinstance(pushed, dict) and pushed.get('name') == pushed_name:
+                print('already pushed docker image: {0}'.format(pushed_name))
+                continue
+
+            print('pushing docker image: {0} {1}:{2}'.format(local_image_name, docker_hub_image, docker_hub_tag))
+
+            future = executor.submit(_push_image,
+                                     task,
+                                     build_path,
+                                     settings,
+                                     local_image_name,
+                                     docker_hub_image,
+                                     docker_hub_tag,
+                                     pull=bool(cached_images))
+            futures[future] = (image_name, pushed_name)
+
+    failures = []
+    for future in futures:
+        image_name, pushed_name = futures[future]
+        try:
+            pushed_images[image_name] = {'name': pushed_name, 'digest': future.result()}
+        except Exception as ex:
+            failures.append('{0}: {1}'.format(pushed_name, ex))
 
-        execute_with_logging(
-            'docker tag {0} {1}:{2}'.format(local_image_name, docker_hub_image, docker_hub_tag),
-            log_filename=_get_tag_log(build_path),
-            tail_callback=_write_log_to_db,
-            tail_callback_obj=task)
+    if failures:
+        raise BobTheBuilderException('{0} of {1} images failed to push:\r\n{2}'.format(
+            len(failures), len(futures), '\r\n'.join(failures)))
 
-        execute_with_logging(
-                'docker push {0}:{1}'.format(docker_hub_image, docker_hub_tag),
-                log_filename=_get_push_log(build_path),
-                tail_callback=_write_log_to_db,
-                tail_callback_obj=task)
+    return pushed_images
 
 
-def do_clean_up(task, source_path, build_path, docker_compose_file):
+def do_clean_up(task, source_path, build_path, docker_compose_file, compose_project):
     print('do_clean_up')
-    if not source_path or not os.path.exists(source_path):
-        return
-
-    os.chdir(source_path)
-    if docker_compose_file:
-        try:
-            execute_with_logging(
-                'docker-compose -f {0} down --remove-orphans --volumes --rmi local'.format(
-                    docker_compose_file),
-                log_filename=_get_down_log(build_path),
-                tail_callback=_write_log_to_db,
-                tail_callback_obj=task)
-        except:
-            pass
-
-    rmtree(source_path)
+    try:
+        touch_project_images(compose_project)
+    except Exception as ex:
+        print('failed to mark images used by {0}: {1}'.format(compose_project, ex))
+
+    if source_path and os.path.exists(source_path):
+        os.chdir(source_path)
+        if docker_compose_file:
+            # the images are left for the image cache to evict, their layers speed up the next build.
+            try:
+                execute_with_logging(
+                    '{0} down --remove-orphans --volumes'.format(
+                        _compose_cmd(docker_compose_file, compose_project)),
+                    log_filename=_get_down_log(build_path),
+                    log_callback=_write_log_to_db,
+                    log_callback_obj=task)
+            except:
+                pass
+
+        rmtree(source_path)
+
+    # only this build's containers and networks, other builds may be running on this host.
+    try:
+        remove_project_containers(compose_project)
+        remove_project_networks(compose_project)
+    except Exception as ex:
+        print('failed to remove containers and networks for {0}: {1}'.format(compose_project, ex))
@@ -0,0 +1,89 @@
+import os
+import yaml
+
+
+def _normalize_image_name(image_name):
+    if ':' in image_name.rsplit('/', 1)[-1] or '@' in image_name:
+        return image_name
+    return image_name + ':latest'
+
+
+def load_compose_services(source_path, docker_compose_file):
+    """
+    returns the services section of the docker compose file, both the version 1 layout
+    and the later ones, which have a top level 'services' with or without a 'version'.
+    """
+    with open(os.path.join(source_path, docker_compose_file), 'r') as f:
+        compose = yaml.safe_load(f) or {}
+
+    if 'services' in compose and isinstance(compose['services'], (dict, type(None))):
+        return compose['services'] or {}
+    return compose
+
+
+def _get_build_files(source_path, docker_compose_file, service):
+    """
+    returns the (context path, dockerfile path) of a service with a build section.
+    """
+    build = service['build']
+    compose_dir = os.path.dirname(os.path.join(source_path, docker_compose_file))
+    if isinstance(build, dict):
+        context = build.get('context', '.')
+        dockerfile = build.get('dockerfile', 'Dockerfile')
+    else:
+        context = build
+        dockerfile = 'Dockerfile'
+
+    context_path = os.path.normpath(os.path.join(compose_dir, context))
+    return context_path, os.path.join(context_path, dockerfile)
+
+
+def read_base_images(dockerfile_path):
+    """
+    returns the images a dockerfile builds FROM, leaving out the names of its own build stages.
+    """
+    images = []
+    stages = set()
+    with open(dockerfile_path, 'r') as f:
+        for line in f:
+            words = line.strip().split()
+            if len(words) < 2 or words[0].upper() != 'FROM':
+                continue
+
+            words = [word for word in words[1:] if not word.startswith('--')]
+            if not words:
+                continue
+            if words[0] not in stages:
+                images.append(_normalize_image_name(words[0]))
+            if len(words) >= 3 and words[1].upper() == 'AS':
+                stages.add(words[2])
+    return images
+
+
+def get_build_graph(source_path, docker_compose_file):
+    """
+    returns a dictionary of each service with a build section to the services it must be built after:
+    those whose image its dockerfile builds FROM.
+    """
+    services = load_compose_services(source_path, docker_compose_file)
+
+    built = {}
+    for name in services:
+        if isinstance(services[name], dict) and 'build' in services[name]:
+            built[name] = services[name]
+
+    # a service's image is only known to other dockerfiles by its image: name.
+    image_services = {}
+    for name in built:
+        if built[name].get('image'):
+            image_services[_normalize_image_name(built[name]['image'])] = name
+
+    graph = {}
+    for name in built:
+        _, dockerfile_path = _get_build_files(source_path, docker_compose_file, built[name])
+        depends_on = set()
+        for image in read_base_images(dockerfile_path):
+            if image in image_services and image_services[image] != name:
+                depends_on.add(image_services[image])
+        graph[name] = depends_on
+    return graph
@@ -0,0 +1,158 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from os.path import expanduser
+from shutil import disk_usage
+from time import time
+
+import docker.errors
+
+from bob.worker.docker_client import get_docker_client
+from bob.worker.settings import get_base_build_path
+
+
+def _get_cache_file():
+    return os.path.join(expanduser("~"), 'bob/image-cache.json')
+
+
+@contextmanager
+def _locked_cache(cache_file=None):
+    """
+    yields the {image id: last used epoch} dictionary, saving it on exit.
+    the file is locked as every build process of the worker updates it.
+    """
+    cache_file = cache_file or _get_cache_file()
+    with open(cache_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            text = f.read()
+            last_used = json.loads(text) if text else {}
+            yield last_used
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(last_used))
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _image_and_parents(image_id, docker_client):
+    """
+    returns the image id and the ids of the local images it was built from.
+    """
+    ids = [image_id]
+    for layer in docker_client.history(image_id):
+        layer_id = layer.get('Id')
+        if layer_id and layer_id != '<missing>':
+            ids.append(layer_id)
+    return ids
+
+
+def touch_project_images(compose_project, docker_client=None):
+    """
+    marks the images a build used as just used: the images it built, the images its containers ran
+    and every local base / intermediate image they were built from.
+    """
+    docker_client = docker_client or get_docker_client()
+    image_ids = set()
+
+    for image in docker_client.images(name='{0}_*'.format(compose_project)):
+        image_ids.add(image['Id'])
+
+    label = 'com.docker.compose.project={0}'.format(compose_project)
+    for container in docker_client.containers(all=True, filters={'label': label}):
+        image_ids.add(container['ImageID'])
+
+    used_ids = set()
+    for image_id in image_ids:
+        try:
+            used_ids.update(_image_and_parents(image_id, docker_client))
+        except docker.errors.APIError:
+            continue
+
+    now = time()
+    with _locked_cache() as last_used:
+        for image_id in used_ids:
+            last_used[image_id] = now
+
+
+def remove_project_containers(compose_project, docker_client=None):
+    """
+    removes the containers docker compose created for the given project, leaving their images cached.
+    """
+    docker_client = docker_client or get_docker_client()
+    label = 'com.docker.compose.project={0}'.format(compose_project)
+    for container in docker_client.containers(all=True, filters={'label': label}):
+        docker_client.remove_container(container['Id'], v=True, force=True)
+
+
+def _get_disk_used_percent(docker_client):
+    path = docker_client.info().get('DockerRootDir')
+    if not path or not os.path.exists(path):
+        path = get_base_build_path()
+    usage = disk_usage(path)
+    return 100.0 * usage.used / usage.total
+
+
+def _remove_image(image, docker_client):
+    """
+    removes the image without force, so docker refuses while a container uses it.
+    an image with several tags is removed tag by tag, docker removes it with its last tag.
+    """
+    tags = [tag for tag in image.get('RepoTags') or [] if tag != '<none>:<none>']
+    for tag in tags or [image['Id']]:
+        docker_client.remove_image(tag, noprune=False)
+
+
+def evict_images(high_water_mark=80, low_water_mark=70, min_idle_seconds=60 * 60, docker_client=None):
+    """
+    once the docker disk is more than high_water_mark percent used, removes the least recently used images
+    until it is below low_water_mark percent.
+    images used within min_idle_seconds are kept, a running build may be about to use them.
+    an image with no recorded use, e.g. a base image a running build just pulled, is recorded as used when it is
+    first seen here, its Created date is when it was built and says nothing about when it was pulled.
+    :return: the ids of the images removed.
+    """
+    docker_client = docker_client or get_docker_client()
+    if _get_disk_used_percent(docker_client) < high_water_mark:
+        return []
+
+    with _locked_cache() as last_used:
+        images = docker_client.images(all=False)
+        now = time()
+        for image in images:
+            last_used.setdefault(image['Id'], now)
+
+        removed = []
+        for image in sorted(images, key=lambda image: (last_used[image['Id']], image['Id'])):
+            if now - last_used[image['Id']] < min_idle_seconds:
+                break
+            if _get_disk_used_percent(docker_client) < low_water_mark:
+                break
+            try:
+                print('evicting image: {0} {1}'.format(image['Id'], image.get('RepoTags')))
+                _remove_image(image, docker_client)
+                removed.append(image['Id'])
+                last_used.pop(image['Id'], None)
+            except docker.errors.APIError as ex:
+                # still used by a container, or a parent of another image.
+                print('could not evict image {0}: {1}'.format(image['Id'], ex))
+
+        # forget images removed by something else.
+        local_ids = set(image['Id'] for image in docker_client.images(all=True))
+        for image_id in list(last_used):
+            if image_id not in local_ids:
+                del last_used[image_id]
+
+    return removed
+
+
+def evict_images_from_settings(settings):
+    """
+    evict_images() with the 'docker_cache' section of worker-settings.yml.
+    """
+    cache_settings = settings.get('docker_cache') or {}
+    return evict_images(high_water_mark=cache_settings.get('high_water_mark', 80),
+                        low_water_mark=cache_settings.get('low_water_mark', 70),
+                        min_idle_seconds=cache_settings.get('min_idle_seconds', 60 * 60))
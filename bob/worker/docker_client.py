@@ -1,47 +1,67 @@
+import os
 import docker
-from time import time
 
+_client = None
+_client_pid = None
 
-def get_docker_client():
+
+def _create_docker_client():
     try:
         return docker.APIClient()
     except:
         return docker.Client()
 
 
-def get_recent_images(docker_client=get_docker_client(),
-                      created_from_in_epoc=time()-48*60*60):
+def get_docker_client():
     """
-    returns images with:
-     1) a Created time greater than or equal to created_from_in_epoc.
-     2) Images with something in the RepoTags.
+    returns this process's docker client, connecting on first use.
+    a forked child makes its own rather than sharing the parent's connection pool.
     """
-    for image in docker_client.images():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = _create_docker_client()
+        _client_pid = os.getpid()
+    return _client
 
-        created = image.get('Created')
-        if not created or created < created_from_in_epoc:
-            continue
 
-        repo_tags = image.get('RepoTags')
-        if not repo_tags or len(repo_tags) == 0:
-            continue
+def find_build_images(compose_project, image_names, docker_client=None):
+    """
+    returns the local images a build may push, narrowed by the docker daemon instead of listing every image:
+    the images docker compose built for the project, by its label or its <project>_<service> name,
+    and the images named in image_names.
+    """
+    docker_client = docker_client or get_docker_client()
+    queries = [{'filters': {'label': 'com.docker.compose.project={0}'.format(compose_project)}},
+               {'name': '{0}_*'.format(compose_project)},
+               {'name': '{0}-*'.format(compose_project)}]
+    for image_name in image_names:
+        queries.append({'name': image_name})
 
-        has_valid_tag = False
-        for tag in repo_tags:
-            if tag and tag != '<none>:<none>':
-                has_valid_tag = True
-                break
+    images = {}
+    for query in queries:
+        for image in docker_client.images(**query):
+            images[image['Id']] = image
+    return list(images.values())
 
-        if not has_valid_tag:
-            continue
 
-        yield image
+def images_exist(image_ids, docker_client=None):
+    """
+    returns True if every one of the images is still on this worker.
+    """
+    docker_client = docker_client or get_docker_client()
+    for image_id in image_ids:
+        try:
+            docker_client.inspect_image(image_id)
+        except docker.errors.NotFound:
+            return False
+    return True
 
 
-def remove_all_docker_networks(docker_client=get_docker_client()):
+def remove_all_docker_networks(docker_client=None):
     """
     removes an non-default docker networks, and stops any container relate to them.
     """
+    docker_client = docker_client or get_docker_client()
     for net in docker_client.networks():
         if net['Name'] in ('bridge', 'host', 'none'):
             continue
@@ -52,10 +72,27 @@ def remove_all_docker_networks(docker_client=get_docker_client()):
         docker_client.remove_network(net['Id'])
 
 
-def remove_all_docker_images(client=get_docker_client()):
+def remove_project_networks(compose_project, docker_client=None):
     """
-    removes all images and containers on machine
+    removes the networks docker compose created for the given project,
+    and stops any container still attached to them.
     """
+    docker_client = docker_client or get_docker_client()
+    label = 'com.docker.compose.project={0}'.format(compose_project)
+    for net in docker_client.networks(filters={'label': label}):
+        # the network list does not include the attached containers.
+        details = docker_client.inspect_network(net['Id'])
+        for con_id in details.get('Containers') or {}:
+            docker_client.stop(con_id)
+
+        docker_client.remove_network(net['Id'])
+
+
+def remove_all_docker_containers(client=None):
+    """
+    removes all containers on machine, only safe while no build is running.
+    """
+    client = client or get_docker_client()
     for container in client.containers(all=True):
         if container.get('State') == 'running':
             print('stopping container: {0}'.format(container))
@@ -64,7 +101,3 @@ def remove_all_docker_images(client=get_docker_client()):
     for container in client.containers(all=True):
         print('removing container: {0}'.format(container))
         client.remove_container(container)
-
-    for image in client.images():
-        print('removing image: {0}'.format(image))
-        client.remove_image(image, force=True)
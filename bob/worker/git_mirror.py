@@ -0,0 +1,146 @@
+import fcntl
+import os
+import subprocess
+from contextlib import contextmanager
+from os.path import expanduser
+from shutil import rmtree
+
+from bob.common.exceptions import BobTheBuilderException
+from bob.common.tools import mkdir_p
+
+
+def _git(args, git_dir=None, timeout=60 * 30):
+    """
+    runs git, returns its stdout as text.
+    the command line is left out of errors as fetch urls can contain credentials.
+    """
+    cmd = ['git']
+    if git_dir:
+        cmd.append('--git-dir={0}'.format(git_dir))
+    cmd.extend(args)
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, timeout=timeout)
+    except subprocess.CalledProcessError as ex:
+        raise BobTheBuilderException('git {0} failed: {1}'.format(
+            args[0], ex.output.decode('utf-8', 'replace').strip()))
+    except subprocess.TimeoutExpired:
+        raise BobTheBuilderException('git {0} timed out'.format(args[0]))
+    return output.decode('utf-8', 'replace').strip()
+
+
+def _get_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class GitMirrorCache(object):
+    """
+    keeps a bare mirror of each git repo on the worker, updated with an incremental fetch,
+    and checks builds out of it as detached worktrees.
+    """
+
+    def __init__(self, path, max_size_bytes):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        mkdir_p(path)
+
+    def _mirror_path(self, repo):
+        return os.path.join(self.path, repo + '.git')
+
+    @contextmanager
+    def _lock(self, repo, blocking=True):
+        """
+        serialises the builds using a mirror, the lock file's mtime records when it was last used.
+        yields False if blocking is False and the mirror is in use.
+        """
+        lock_path = self._mirror_path(repo) + '.lock'
+        mkdir_p(os.path.dirname(lock_path))
+        with open(lock_path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _fetch(self, repo, url):
+        git_dir = self._mirror_path(repo)
+        if not os.path.exists(os.path.join(git_dir, 'HEAD')):
+            _git(['init', '--bare', '--quiet', git_dir])
+
+        # forget the worktrees of builds that have been cleaned up.
+        _git(['worktree', 'prune'], git_dir=git_dir)
+
+        # the url is given on each fetch rather than saved, so credentials never land on disk.
+        _git(['fetch', '--prune', '--quiet', url,
+              '+refs/heads/*:refs/heads/*',
+              '+refs/tags/*:refs/tags/*'], git_dir=git_dir)
+        return git_dir
+
+    def checkout(self, repo, url, ref, dest_path):
+        """
+        brings the repo's mirror up to date, then checks ref out into dest_path.
+        :param repo: the repo name e.g. 'metocean/bob-the-builder', used for the mirror's path.
+        :param url: the url to fetch from e.g. 'https://github.com/metocean/bob-the-builder.git' or 'file:///...'
+        :param ref: a full ref e.g. 'refs/heads/master', 'refs/tags/v1.0.2' or a commit sha.
+        :param dest_path: the directory to check out to, must not exist.
+        :return: the commit sha checked out.
+        """
+        with self._lock(repo):
+            os.utime(self._mirror_path(repo) + '.lock', None)
+            git_dir = self._fetch(repo, url)
+            sha = _git(['rev-parse', '--verify', '{0}^{{commit}}'.format(ref)], git_dir=git_dir)
+            _git(['worktree', 'add', '--detach', dest_path, sha], git_dir=git_dir)
+        return sha
+
+    def evict(self):
+        """
+        removes the least recently used mirrors until the cache is under max_size_bytes.
+        mirrors that are in use are skipped.
+        """
+        mirrors = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith('.git.lock'):
+                    lock_path = os.path.join(dirpath, filename)
+                    repo = os.path.relpath(lock_path, self.path)[:-len('.git.lock')]
+                    mirrors.append((os.path.getmtime(lock_path), repo))
+
+        sizes = dict((repo, _get_size(self._mirror_path(repo))) for _, repo in mirrors)
+        total = sum(sizes.values())
+
+        for _, repo in sorted(mirrors):
+            if total <= self.max_size_bytes:
+                break
+            with self._lock(repo, blocking=False) as locked:
+                if not locked:
+                    continue
+                print('evicting git mirror: {0}'.format(repo))
+                rmtree(self._mirror_path(repo), ignore_errors=True)
+                os.remove(self._mirror_path(repo) + '.lock')
+                total -= sizes[repo]
+
+
+def get_git_mirror_cache(settings):
+    """
+    returns the GitMirrorCache configured under 'git_mirror' in worker-settings.yml, None if disabled.
+        git_mirror:
+          path: ~/bob/mirrors
+          max_size_gb: 20
+          enabled: true
+    """
+    mirror_settings = settings.get('git_mirror') or {}
+    if not mirror_settings.get('enabled', True):
+        return None
+    path = expanduser(mirror_settings.get('path', '~/bob/mirrors'))
+    max_size_bytes = int(float(mirror_settings.get('max_size_gb', 20)) * 1024 ** 3)
+    return GitMirrorCache(path, max_size_bytes)
@@ -0,0 +1,131 @@
+import json
+import re
+import requests
+
+from bob.common.exceptions import BobTheBuilderException
+
+_docker_hub_registry = 'registry-1.docker.io'
+
+_manifest_types = ('application/vnd.docker.distribution.manifest.v2+json',
+                   'application/vnd.oci.image.manifest.v1+json',
+                   'application/vnd.docker.distribution.manifest.list.v2+json',
+                   'application/vnd.oci.image.index.v1+json')
+
+# plain http is only used for a registry on this machine, the same as docker does.
+_insecure_hosts = ('localhost', '127.0.0.1')
+
+_timeout = 30
+
+
+def split_image_name(image):
+    """
+    returns the (registry host, repository) of a docker image name without its tag,
+    e.g. metocean/bob -> (registry-1.docker.io, metocean/bob), localhost:5000/bob -> (localhost:5000, bob).
+    """
+    parts = image.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        return parts[0], parts[1]
+
+    if len(parts) == 1:
+        return _docker_hub_registry, 'library/' + image
+    return _docker_hub_registry, image
+
+
+def is_docker_hub(image):
+    return split_image_name(image)[0] == _docker_hub_registry
+
+
+def _parse_challenge(header):
+    """
+    returns the parameters of a 'Bearer realm="...",service="...",scope="..."' WWW-Authenticate header.
+    """
+    if not header or not header.lower().startswith('bearer '):
+        return None
+    return dict(re.findall(r'(\w+)="([^"]*)"', header))
+
+
+class RegistryClient(object):
+    """
+    talks to the docker registry http api v2 for one repository,
+    enough to read a tag's manifest and point another tag at it without pushing any layers.
+    """
+
+    def __init__(self, image, login=None, password=None):
+        self.host, self.repository = split_image_name(image)
+        self.login = login
+        self.password = password
+        self.token = None
+        self.session = requests.Session()
+
+        host_name = self.host.split(':', 1)[0]
+        scheme = 'http' if host_name in _insecure_hosts else 'https'
+        self.base_url = '{0}://{1}/v2/{2}'.format(scheme, self.host, self.repository)
+
+    def _auth(self):
+        if self.login and self.password:
+            return self.login, self.password
+        return None
+
+    def _get_token(self, challenge):
+        params = {'service': challenge.get('service')}
+        params['scope'] = challenge.get('scope') or 'repository:{0}:pull,push'.format(self.repository)
+        response = self.session.get(challenge['realm'], params=params, auth=self._auth(), timeout=_timeout)
+        response.raise_for_status()
+        body = response.json()
+        return body.get('token') or body.get('access_token')
+
+    def _request(self, method, url, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if self.token:
+            headers['Authorization'] = 'Bearer {0}'.format(self.token)
+
+        response = self.session.request(method, url, headers=headers, timeout=_timeout, **kwargs)
+        if response.status_code != 401:
+            return response
+
+        challenge = _parse_challenge(response.headers.get('WWW-Authenticate'))
+        if challenge and 'realm' in challenge:
+            self.token = self._get_token(challenge)
+            headers['Authorization'] = 'Bearer {0}'.format(self.token)
+            return self.session.request(method, url, headers=headers, timeout=_timeout, **kwargs)
+
+        return self.session.request(method, url, headers=headers, auth=self._auth(), timeout=_timeout, **kwargs)
+
+    def get_manifest(self, reference):
+        """
+        returns the (digest, content type, body) of the manifest of a tag or digest, None if there is none.
+        """
+        response = self._request('GET',
+                                 '{0}/manifests/{1}'.format(self.base_url, reference),
+                                 headers={'Accept': ', '.join(_manifest_types)})
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise BobTheBuilderException('registry returned {0} for {1}/{2}:{3}'.format(
+                response.status_code, self.host, self.repository, reference))
+
+        return (response.headers.get('Docker-Content-Digest'),
+                response.headers.get('Content-Type'),
+                response.content)
+
+    def put_manifest(self, tag, content_type, body):
+        """
+        points tag at the given manifest, its layers must already be in the repository.
+        """
+        response = self._request('PUT',
+                                 '{0}/manifests/{1}'.format(self.base_url, tag),
+                                 headers={'Content-Type': content_type},
+                                 data=body)
+        if response.status_code not in (200, 201):
+            raise BobTheBuilderException('registry returned {0} tagging {1}/{2}:{3}'.format(
+                response.status_code, self.host, self.repository, tag))
+
+
+def get_config_digest(content_type, body):
+    """
+    returns the image config digest of a single platform manifest, which is the image id docker shows locally.
+    returns None for a manifest list.
+    """
+    if content_type not in _manifest_types[:2]:
+        return None
+    return json.loads(body.decode('utf-8')).get('config', {}).get('digest')
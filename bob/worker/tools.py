@@ -1,12 +1,16 @@
 import json
 import os
 import pycurl
+import selectors
+import shutil
 import subprocess
 import smtplib
+import time
 from email.mime.text import MIMEText
 from bob.worker.settings import load_settings
 import socket
-from bob.common.exceptions import BobProcessExecutionError
+from bob.common.exceptions import BobTheBuilderException, BobProcessExecutionError
+from bob.common.tools import mkdir_if_not_exist
 
 
 def execute(cmd, logfile=None):
@@ -18,87 +22,125 @@ def execute(cmd, logfile=None):
                 raise BobProcessExecutionError('"{0}" exited with {1} check logfile for details {2}'.format(
                     cmd,
                     error_code,
-                    logfile), cmd=cmd, returncode=error_code)
+                    logfile), cmd=cmd, returncode=error_code, details=None)
     else:
         error_code = subprocess.call(cmd, shell=True)
         if error_code:
             raise BobProcessExecutionError('"{0}" exited with {1}'.format(cmd, error_code),
-                                           cmd=cmd, returncode=error_code)
+                                           cmd=cmd, returncode=error_code, details=None)
 
 
-def tail(filename, max_bytes='10KB', tail_cmd_timeout=5):
+def _decode(data):
+    try:
+        return bytes(data).decode("utf-8", "strict")
+    except UnicodeDecodeError:
+        return bytes(data).decode("utf-8", "backslashreplace")
+
+
+def tail(filename, max_bytes=10 * 1024):
     """
     returns the tail of the given file.
     :param filename: the filename / path you wish to return the tail of
-    :param num_of_lines: the number of lines you wish to tail.
-    :param tail_cmd_timeout: how long to wait before giving up on the tail request.
-    :return: returns None if the file tail Timeout.
+    :param max_bytes: the number of bytes to return from the end of the file.
+    :return: returns None if the file cannot be read.
     """
     try:
-        result = subprocess.check_output(['tail',
-                                          '-c {0}'.format(max_bytes),
-                                          filename],
-                                         timeout=tail_cmd_timeout)
-        try:
-            return bytes(result).decode("utf-8", "strict")
-        except: # UnicodeDecodeError or UnicodeDecodeErrors who knows?? we just catch all.
-            try:
-                return bytes(result).decode("utf-8", "backslashreplace")
-            except:
-                return bytes(result).decode("ascii", "backslashreplace")
-
-    except subprocess.TimeoutExpired:
-        return None
-    except subprocess.CalledProcessError:
-        return None
-    except:
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - max_bytes))
+            return _decode(f.read())
+    except (IOError, OSError):
         return None
 
 
+class _LogPump(object):
+    """
+    copies a process's output to the log file as it arrives,
+    keeps the last max_bytes in memory and hands increments to the log callback.
+    the flush interval grows from flush_interval to max_flush_interval, each flush is a chunk in the log store,
+    so a long build's log is not thousands of chunks.
+    """
+
+    def __init__(self, log, log_filename, log_callback, log_callback_obj, max_bytes, flush_interval, flush_bytes,
+                 max_flush_interval):
+        self.log = log
+        self.log_filename = log_filename
+        self.log_callback = log_callback
+        self.log_callback_obj = log_callback_obj
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_flush_interval = max_flush_interval
+        self.flush_bytes = flush_bytes
+        self.tail = bytearray()
+        self.pending = bytearray()
+        self.flushed_at = time.time()
+
+    def write(self, data):
+        self.log.write(data)
+        self.log.flush()
+        self.pending += data
+        self.tail += data
+        if len(self.tail) > self.max_bytes:
+            del self.tail[:len(self.tail) - self.max_bytes]
+        if len(self.pending) >= self.flush_bytes:
+            self.flush()
+
+    def next_flush_in(self):
+        return max(0, self.flushed_at + self.flush_interval - time.time())
+
+    def flush(self):
+        self.flushed_at = time.time()
+        if not self.pending:
+            return
+        data = bytes(self.pending)
+        self.pending = bytearray()
+        self.flush_interval = min(self.max_flush_interval, self.flush_interval * 1.5)
+        if self.log_callback:
+            self.log_callback(data, self.log_filename, self.log_callback_obj)
+
+    def get_tail(self):
+        return _decode(self.tail)
+
+
 def execute_with_logging(cmd,
                          log_filename,
-                         tail_callback,
-                         tail_callback_obj,
-                         max_bytes='10KB',
-                         tail_interval=15,
-                         tail_first_interval=2,
+                         log_callback,
+                         log_callback_obj,
+                         max_bytes=10 * 1024,
+                         flush_interval=2,
+                         flush_bytes=256 * 1024,
+                         max_flush_interval=30,
                          terminate_timeout=9):
     """
-    executes the shell process with logging.
+    executes the shell process with logging, its output is read from a pipe as it is written.
     :param cmd: the shell command to execute
-    :param log_filename: the filename / path where you wish the log to be stored
-    :param tail_callback: this call back function is called with the tail for the given log file.
-    :param num_of_lines: the number of lines to tail in the log callback
-    :param tail_interval: the interval between tail_callback()s.
+    :param log_filename: the filename / path where you wish the log to be appended.
+    :param log_callback: called with (bytes, log_filename, log_callback_obj) for the output not yet passed to it,
+                         every flush_interval seconds, growing to max_flush_interval, or once flush_bytes have arrived.
+    :param max_bytes: the size of the output's tail kept for the error details.
     """
 
-    first_interval = True
-    with open(log_filename, 'w') as log:
-        log.write(cmd + '\n------\n\n')
-        log.flush()
+    with open(log_filename, 'ab') as log:
+        pump = _LogPump(log, log_filename, log_callback, log_callback_obj, max_bytes, flush_interval, flush_bytes,
+                        max_flush_interval)
+        pump.write((cmd + '\n------\n\n').encode('utf-8'))
 
         proc = subprocess.Popen(cmd,
                                 shell=True,
-                                stdout=log,
-                                stderr=log)
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
         try:
-            while proc.returncode is None:
-                try:
-                    if first_interval and tail_first_interval > 0:
-                        first_interval = False
-                        proc.wait(tail_first_interval)
-                    else:
-                        proc.wait(tail_interval)
-                except subprocess.TimeoutExpired:
-                    pass
-                lines = tail(log_filename, max_bytes)
-                if tail_callback and lines:
-                    tail_callback(lines, log_filename, tail_callback_obj)
-
-            # do one last tail so we get the end of log
-            lines = tail(log_filename, max_bytes)
-            if tail_callback and lines:
-                tail_callback(lines, log_filename, tail_callback_obj)
+            with selectors.DefaultSelector() as selector:
+                selector.register(proc.stdout, selectors.EVENT_READ)
+                while True:
+                    if selector.select(timeout=pump.next_flush_in()):
+                        data = os.read(proc.stdout.fileno(), 64 * 1024)
+                        if not data:
+                            break
+                        pump.write(data)
+                    if not pump.next_flush_in():
+                        pump.flush()
+            proc.wait()
 
             if proc.returncode != 0:
                 raise BobProcessExecutionError('"{cmd}" exited with {returncode} check logfile for details {log_filename}'.format(
@@ -107,12 +149,11 @@ def execute_with_logging(cmd,
                     log_filename=log_filename),
                     cmd=cmd,
                     returncode=proc.returncode,
-                    details=lines
+                    details=pump.get_tail()
                 )
         finally:
-            log.write('\n\n------\n' + cmd + '\n')
-            log.flush()
-
+            # stop the process before the last flush, which writes to the log store and the db and may fail.
+            proc.stdout.close()
             if proc.returncode is None:
                 proc.terminate()
                 try:
@@ -120,6 +161,12 @@ def execute_with_logging(cmd,
                 except subprocess.TimeoutExpired:
                     proc.kill()
 
+            try:
+                pump.write(('\n\n------\n' + cmd + '\n').encode('utf-8'))
+                pump.flush()
+            except Exception as ex:
+                # do not hide the build's own error behind this one.
+                print('failed to save the end of {0}: {1}'.format(log_filename, ex))
 
 
 def url_download(url, filepath, auth_username=None, auth_password=None):
@@ -137,6 +184,136 @@ def url_download(url, filepath, auth_username=None, auth_password=None):
     return status
 
 
+def _strip_first_component(name):
+    """
+    github archives put everything under a '<owner>-<repo>-<sha>/' directory, returns the name without it.
+    """
+    parts = name.lstrip('/').split('/', 1)
+    return parts[1] if len(parts) > 1 else ''
+
+
+def _check_archive_name(name):
+    if name.startswith('/') or '..' in name.split('/'):
+        raise BobTheBuilderException('archive member "{0}" is outside the archive'.format(name))
+
+
+def _extract_tar_stream(fileobj, dest_path):
+    """
+    extracts a gzipped tar as it is read from fileobj, one member at a time.
+    """
+    import tarfile
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            name = _strip_first_component(member.name)
+            if not name:
+                continue
+            _check_archive_name(name)
+            member.name = name
+            if member.islnk():
+                member.linkname = _strip_first_component(member.linkname)
+            tar.extract(member, dest_path)
+
+
+def _extract_zip(fileobj, dest_path):
+    import zipfile
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            name = _strip_first_component(info.filename)
+            if not name:
+                continue
+            _check_archive_name(name)
+            path = os.path.join(dest_path, name)
+            if name.endswith('/'):
+                mkdir_if_not_exist(path)
+                continue
+            mkdir_if_not_exist(os.path.dirname(path))
+            with archive.open(info) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(path, mode)
+
+
+def _curl_to(url, write, auth_username=None, auth_password=None):
+    """
+    performs a GET passing the body of a successful response to write() as it arrives.
+    :return: the http status.
+    """
+    curl = pycurl.Curl()
+    # the status of the response being received, pycurl does not allow getinfo() during perform().
+    response = {'status': 0}
+
+    def _header(line):
+        if line.startswith(b'HTTP/'):
+            parts = line.split()
+            response['status'] = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+
+    def _write(data):
+        # redirect and error pages are not part of the archive.
+        if 200 <= response['status'] < 300:
+            write(data)
+
+    try:
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.HEADERFUNCTION, _header)
+        curl.setopt(pycurl.WRITEFUNCTION, _write)
+        curl.setopt(pycurl.FOLLOWLOCATION, True)
+        if auth_username and auth_password:
+            curl.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+            curl.setopt(pycurl.USERPWD, "%s:%s" % (auth_username, auth_password))
+        curl.perform()
+        return curl.getinfo(pycurl.HTTP_CODE)
+    finally:
+        curl.close()
+
+
+def url_download_extract(url, dest_path, auth_username=None, auth_password=None, archive_format='tar'):
+    """
+    downloads an archive and extracts it into dest_path while it downloads, nothing is written but the files.
+    the archive's top level directory is left out, its contents go straight into dest_path.
+    :param archive_format: 'tar' for a (gzipped) tarball, extracted as a stream.
+                           'zip' is buffered in memory (or a temp file when large) as zip needs to seek.
+    :return: the http status.
+    """
+    import threading
+    from tempfile import SpooledTemporaryFile
+
+    mkdir_if_not_exist(dest_path)
+
+    if archive_format == 'zip':
+        with SpooledTemporaryFile(max_size=64 * 1024 * 1024) as buffer:
+            status = _curl_to(url, buffer.write, auth_username, auth_password)
+            if status < 400:
+                buffer.seek(0)
+                _extract_zip(buffer, dest_path)
+        return status
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def _extract():
+        with os.fdopen(read_fd, 'rb') as reader:
+            try:
+                _extract_tar_stream(reader, dest_path)
+            except Exception as ex:
+                errors.append(ex)
+            # keep reading so the download never blocks on a full pipe.
+            while reader.read(64 * 1024):
+                pass
+
+    extractor = threading.Thread(target=_extract)
+    extractor.start()
+    try:
+        with os.fdopen(write_fd, 'wb') as writer:
+            status = _curl_to(url, writer.write, auth_username, auth_password)
+    finally:
+        extractor.join()
+
+    if errors and status < 400:
+        raise BobTheBuilderException('could not extract "{0}": {1}'.format(url, errors[0]))
+    return status
+
+
 def url_get_utf8(url, auth_username=None, auth_password=None):
     try:
         # Python 3
@@ -241,3 +418,28 @@ def get_hostname():
         return socket.gethostname()
     except:
         return ''
+
+
+def get_load_per_cpu():
+    """
+    returns the 1 minute load average divided by the number of cpus, None if unknown.
+    """
+    try:
+        from multiprocessing import cpu_count
+        return os.getloadavg()[0] / cpu_count()
+    except (OSError, NotImplementedError):
+        return None
+
+
+def get_free_memory_mb(meminfo_path='/proc/meminfo'):
+    """
+    returns the memory available for new processes in MB, None if unknown.
+    """
+    try:
+        with open(meminfo_path, 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, ValueError):
+        pass
+    return None
@@ -1,31 +1,42 @@
 import os
+import random
 import signal
+import threading
 from multiprocessing import Process
-from time import sleep
+from shutil import disk_usage
+from time import sleep, time
 import requests.exceptions
 
-from bob.common.task import (State, Task)
-from bob.common.exceptions import BobTheBuilderException, BobProcessExecutionError
+from bob.common.task import (State, Task, Priority)
+from bob.common.exceptions import BobTheBuilderException, BobProcessExecutionError, BobTaskConflictError
 import bob.common.queues as queues
 import bob.common.db as db
 from bob.worker.tools import (send_email,
                               get_ipaddress,
                               get_hostname,
-                              tail)
+                              get_load_per_cpu,
+                              get_free_memory_mb)
 
 from bob.worker.builder import (do_download_git_repo,
                                 do_build_dockers,
                                 do_test_dockers,
                                 do_push_dockers,
-                                do_clean_up)
+                                do_clean_up,
+                                match_built_images,
+                                log_retry,
+                                save_log_file)
 
 from bob.worker.docker_client import (remove_all_docker_networks,
-                                      remove_all_docker_images)
+                                      remove_all_docker_containers,
+                                      images_exist)
+from bob.worker.docker_cache import evict_images_from_settings
+from bob.worker.build_cache import get_cache_key, find_cached_images, save_pushed_images
 
-from bob.worker.settings import get_base_build_path
+from bob.worker.settings import get_base_build_path, load_settings
 from bob.common.tools import mkdir_p
 from shutil import rmtree
 from datetime import datetime
+from dateutil.parser import parse as parse_date
 import traceback
 import bob
 
@@ -35,9 +46,9 @@ def _set_state(task,
                message=None,
                email_addresses=[]):
     task.set_state(state=state, message=message)
-    db.save_task(task)
+    saved_task = db.save_task_state(task)
     _send_state_email(task, state, message, email_addresses)
-    return db.reload_task(task)
+    return saved_task
 
 
 def _send_state_email(task, state, message, email_addresses):
@@ -67,6 +78,11 @@ def _handle_exception(task, build_path, email_addresses, ex):
 
     traceback.print_exc()
 
+    if isinstance(ex, BobTaskConflictError):
+        # someone else (e.g. a cancel) has changed the task, do not overwrite their state.
+        print('not failing task: {0}'.format(ex.message))
+        return
+
     if isinstance(ex, BobProcessExecutionError):
         message = 'build failed while {0}: {1}'.format(task.state, str(ex))
     elif isinstance(ex, BobTheBuilderException):
@@ -74,29 +90,88 @@ def _handle_exception(task, build_path, email_addresses, ex):
     else:
         message = 'build failed while {0}: {1}'.format(task.state, ex.__class__.__name__)
 
-    _set_state(task,
-               state=State.failed,
-               message=message,
-               email_addresses=email_addresses)
+    try:
+        _set_state(task,
+                   state=State.failed,
+                   message=message,
+                   email_addresses=email_addresses)
+    except BobTaskConflictError as conflict:
+        print('not failing task: {0}'.format(conflict.message))
+        return
 
     log_path = os.path.join(build_path, 'error.log')
     with open(log_path, 'w') as f:
         f.write(datetime.utcnow().isoformat() + '\n')
         traceback.print_exc(file=f)
 
-    text = tail(filename=log_path)
-    if text and len(text) > 0:
-        task.save_log(text, log_path, insert_first=True)
-        db.save_task(task)
+    save_log_file(task, log_path, insert_first=True, rewrite=True)
+
+
+def _save_checkpoint(task):
+    db.save_task_attributes(task, ('checkpoint',))
+
+
+def _get_resume_state(checkpoint, task, test_service):
+    """
+    returns the state to resume a build from, None if it has to be built again:
+    the source must be the same commit and the built images must still be on this worker.
+    """
+    if not checkpoint or checkpoint.get('stage') not in (State.building, State.testing):
+        return None
+
+    if not task.git_sha or checkpoint.get('git_sha') != task.git_sha:
+        print('not resuming, the source has moved on from {0}'.format(checkpoint.get('git_sha')))
+        return None
+
+    images = checkpoint.get('images') or {}
+    if not images or not images_exist(images.values()):
+        print('not resuming, the built images are no longer on this worker')
+        return None
+
+    if checkpoint['stage'] == State.building and test_service:
+        return State.testing
+    return State.pushing
+
+
+def _retry_stage(task, build_path, settings, stage, *args, **kwargs):
+    """
+    runs a stage that only talks to the network (git hub, docker hub), retrying it with exponential backoff,
+    see 'stage_retries' in worker-settings.yml
+    """
+    retries = settings.get('stage_retries') or {}
+    attempts = int(retries.get('attempts', 3))
+    backoff_seconds = float(retries.get('backoff_seconds', 10))
+
+    attempt = 1
+    while True:
+        try:
+            return stage(*args, **kwargs)
+        except BobTaskConflictError:
+            raise
+        except Exception as ex:
+            if attempt >= attempts:
+                raise
+            delay = backoff_seconds * 2 ** (attempt - 1)
+            log_retry(task,
+                      build_path,
+                      '{0} attempt {1} of {2} failed, retrying in {3}s: {4}'.format(
+                          task.state, attempt, attempts, delay, ex))
+            sleep(delay)
+            attempt += 1
 
 
 def _run_build(git_repo, git_branch, git_tag, created_at):
 
     task = db.load_task(git_repo, git_branch, git_tag, created_at)
+    if not task or task.state != State.pending:
+        # superseded or canceled while it was queued.
+        print('not building task, it is {0}'.format(task.state if task else 'missing'))
+        return
 
     setattr(task, 'builder_ipaddress', get_ipaddress())
     setattr(task, 'builder_hostname', get_hostname())
     setattr(task, 'builder_version', bob.__version__)
+    db.save_task_attributes(task, ('builder_ipaddress', 'builder_hostname', 'builder_version'))
 
     # task.builder_ipaddress = get_ipaddress()
     # task.builder_hostname = get_hostname()
@@ -106,6 +181,10 @@ def _run_build(git_repo, git_branch, git_tag, created_at):
     # build image names in do_docker_push(), DONOT change this format! hackie i know :P
     created_at_str = task.created_at.strftime("%Y%m%d%H%M%S%f")
 
+    # the compose project name keeps this build's images, containers and networks
+    # apart from the other builds running on this worker.
+    compose_project = created_at_str
+
     build_path = '{base_build_path}/{git_repo}/{git_branch}/{git_tag}/{created_at}'.format(
         base_build_path=get_base_build_path(),
         git_repo=task.git_repo,
@@ -117,9 +196,16 @@ def _run_build(git_repo, git_branch, git_tag, created_at):
         rmtree(build_path)
     mkdir_p(build_path)
 
+    settings = load_settings()
+
+    # a resumed task picks up after the last stage its previous run finished.
+    resume_from = task.checkpoint or {}
+    task.checkpoint = {}
+
     source_path = None
     docker_compose_file = None
     notification_emails = None
+    cached_images = None
     try:
         while (task.state != State.failed
               and task.state != State.successful):
@@ -132,23 +218,79 @@ def _run_build(git_repo, git_branch, git_tag, created_at):
                  docker_compose_file,
                  services_to_push,
                  test_service,
-                 notification_emails) = do_download_git_repo(task, build_path, created_at_str)
-
-                task = _set_state(task, State.building, email_addresses=notification_emails)
+                 notification_emails) = _retry_stage(task,
+                                                     build_path,
+                                                     settings,
+                                                     do_download_git_repo,
+                                                     task,
+                                                     build_path,
+                                                     created_at_str)
+
+                task.build_cache_key = get_cache_key(task, source_path, docker_compose_file)
+                cached_images = find_cached_images(task.build_cache_key)
+                task.build_cache_hit = cached_images is not None
+                db.save_task_attributes(task, ('git_sha', 'build_cache_key', 'build_cache_hit'))
+
+                task.checkpoint = {'stage': State.downloading,
+                                   'git_sha': task.git_sha,
+                                   'source_path': source_path,
+                                   'docker_compose_file': docker_compose_file,
+                                   'pushed_images': {}}
+
+                resume_state = _get_resume_state(resume_from, task, test_service)
+                if resume_state:
+                    task.checkpoint = dict(resume_from,
+                                           source_path=source_path,
+                                           docker_compose_file=docker_compose_file)
+                    _save_checkpoint(task)
+                    task = _set_state(task,
+                                      resume_state,
+                                      'resuming after {0}'.format(resume_from['stage']),
+                                      email_addresses=notification_emails)
+                elif cached_images:
+                    _save_checkpoint(task)
+                    task = _set_state(task,
+                                      State.pushing,
+                                      'reusing the images of a build of commit {0}'.format(task.git_sha),
+                                      email_addresses=notification_emails)
+                else:
+                    _save_checkpoint(task)
+                    task = _set_state(task, State.building, email_addresses=notification_emails)
 
             elif task.state == State.building:
-                do_build_dockers(task, build_path, source_path, docker_compose_file)
+                do_build_dockers(task, build_path, source_path, docker_compose_file, compose_project)
+                task.checkpoint['images'] = match_built_images(task, build_path, compose_project, services_to_push)
+                task.checkpoint['stage'] = State.building
+                _save_checkpoint(task)
                 if test_service:
                     task = _set_state(task, State.testing, email_addresses=notification_emails)
                 else:
                     task = _set_state(task, State.pushing, email_addresses=notification_emails)
 
             elif task.state == State.testing:
-                do_test_dockers(task, build_path, source_path, docker_compose_file, test_service)
+                do_test_dockers(task, build_path, source_path, docker_compose_file, compose_project, test_service)
+                task.checkpoint['stage'] = State.testing
+                _save_checkpoint(task)
                 task = _set_state(task, State.pushing, email_addresses=notification_emails)
 
             elif task.state == State.pushing:
-                do_push_dockers(task, build_path, source_path, services_to_push)
+                pushed_images = task.checkpoint.setdefault('pushed_images', {})
+                try:
+                    _retry_stage(task,
+                                 build_path,
+                                 settings,
+                                 do_push_dockers,
+                                 task,
+                                 build_path,
+                                 compose_project,
+                                 services_to_push,
+                                 cached_images=cached_images,
+                                 images_to_push=task.checkpoint.get('images'),
+                                 pushed_images=pushed_images)
+                finally:
+                    _save_checkpoint(task)
+                if not cached_images:
+                    save_pushed_images(task, pushed_images)
                 task = _set_state(task, State.successful, email_addresses=notification_emails)
 
             else:
@@ -170,7 +312,7 @@ def _run_build(git_repo, git_branch, git_tag, created_at):
                           ex=ex)
 
     finally:
-        do_clean_up(task, source_path, build_path, docker_compose_file)
+        do_clean_up(task, source_path, build_path, docker_compose_file, compose_project)
 
 
 def _stop_process(process):
@@ -200,7 +342,10 @@ def _cancel_task(task, process):
            and task.state != State.failed
            and task.state != State.canceled):
         _stop_process(process)
-        _set_state(task, State.canceled, 'task was canceled')
+        if task.superseded_by:
+            _set_state(task, State.canceled, 'superseded by the task created at {0}'.format(task.superseded_by))
+        else:
+            _set_state(task, State.canceled, 'task was canceled')
 
 
 def _remove_all_docker_networks_blocking():
@@ -213,71 +358,335 @@ def _remove_all_docker_networks_blocking():
             continue
 
 
-def _remove_all_docker_images_blocking():
+def _evict_docker_images_blocking(settings):
     while True:
         try:
-            remove_all_docker_images()
+            evict_images_from_settings(settings)
             break
         except requests.exceptions.ReadTimeout:
             sleep(10)
             continue
 
 
+class _BuildSlot(object):
+    """
+    a task being built in its own process, its queue message is kept hidden until the build finishes.
+    """
+    def __init__(self, task, process, message):
+        self.task = task
+        self.process = process
+        self.message = message
+        self.cancel_checked_at = time()
+
+
+def _has_headroom(settings, running_builds):
+    """
+    admission control for starting another build, checks the cpu, memory and disk headroom.
+    the first build is always admitted so a busy host still makes progress.
+    """
+    if running_builds == 0:
+        return True
+
+    admission = settings.get('admission') or {}
+
+    max_load_per_cpu = admission.get('max_load_per_cpu', 1.5)
+    load_per_cpu = get_load_per_cpu()
+    if load_per_cpu is not None and load_per_cpu > max_load_per_cpu:
+        return False
+
+    min_free_memory_mb = admission.get('min_free_memory_mb', 2048)
+    free_memory_mb = get_free_memory_mb()
+    if free_memory_mb is not None and free_memory_mb < min_free_memory_mb:
+        return False
+
+    min_free_disk_gb = admission.get('min_free_disk_gb', 10)
+    free_disk_gb = disk_usage(get_base_build_path()).free / float(1024 ** 3)
+    if free_disk_gb < min_free_disk_gb:
+        return False
+
+    return True
+
+
+def _start_build(task, message):
+    process = Process(target=_run_build, args=(
+        task.git_repo,
+        task.git_branch,
+        task.git_tag,
+        task.created_at,))
+    process.start()
+    return _BuildSlot(task, process, message)
+
+
+def _delete_message(message):
+    try:
+        message.delete()
+    except Exception as ex:
+        print('failed to delete the queue message: {0}'.format(ex))
+
+
+def _check_slots(slots, cancel_poll_interval=2):
+    """
+    cancels builds whose task was marked cancel, returns the slots still running.
+    a finished build's queue message is deleted, until then a worker that dies leaves it to be built again.
+    """
+    running = []
+    for slot in slots:
+        slot.process.join(0)
+        if not slot.process.is_alive():
+            print('build finished: {0} {1} {2}'.format(slot.task.git_repo, slot.task.git_branch, slot.task.git_tag))
+            _delete_message(slot.message)
+            continue
+
+        if time() - slot.cancel_checked_at >= cancel_poll_interval:
+            slot.cancel_checked_at = time()
+            if db.load_task_state(slot.task) == State.cancel:
+                _cancel_task(db.reload_task(slot.task), slot.process)
+                _delete_message(slot.message)
+                continue
+
+        running.append(slot)
+    return running
+
+
+_default_priority_weights = {Priority.high: 6, Priority.normal: 3, Priority.low: 1}
+
+# a message stays hidden for _visibility_timeout seconds after each heartbeat, if the worker dies it is redelivered.
+_visibility_timeout = 60
+_heartbeat_interval = 20
+# a building task whose worker has not beaten for this long is taken to be abandoned.
+_abandoned_after = _visibility_timeout * 3
+
+_building_states = (State.downloading, State.building, State.testing, State.pushing)
+
+
+class _Heartbeat(object):
+    """
+    keeps the queue messages of the running and parked builds hidden and marks the running tasks alive,
+    from its own thread so a slow step of the main loop, e.g. evicting images, cannot let a message
+    come back while its build is still running.
+    """
+
+    def __init__(self, interval=_heartbeat_interval):
+        self.interval = interval
+        self.slots = []
+        self.messages = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def update(self, slots, parked):
+        with self.lock:
+            self.slots = list(slots)
+            self.messages = [slot.message for slot in slots] + [message for _, message in parked]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _beat(self):
+        with self.lock:
+            slots = list(self.slots)
+            messages = list(self.messages)
+
+        if messages:
+            queues.change_visibility(messages, _visibility_timeout)
+
+        heartbeat_at = datetime.utcnow().isoformat()
+        for slot in slots:
+            slot.task.heartbeat_at = heartbeat_at
+            db.save_task_attributes(slot.task, ('heartbeat_at',))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self._beat()
+            except Exception as ex:
+                print('heartbeat failed: {0}'.format(ex))
+
+
+def _is_abandoned(task):
+    """
+    returns True if the worker building the task has stopped beating for it.
+    """
+    last_seen = parse_date(task.heartbeat_at) if task.heartbeat_at else task.modified_at
+    return (datetime.utcnow() - last_seen).total_seconds() > _abandoned_after
+
+
+def _get_priority_weights(settings):
+    """
+    returns the 'priority_weights' in worker-settings.yml, the defaults if they are not usable:
+    every weight must be a number of zero or more and at least one must be more than zero.
+    """
+    weights = settings.get('priority_weights')
+    if not weights:
+        return _default_priority_weights
+
+    try:
+        weights = dict((priority, float(weights.get(priority, 0))) for priority in Priority.all)
+    except (AttributeError, TypeError, ValueError):
+        weights = None
+    if not weights or min(weights.values()) < 0 or max(weights.values()) <= 0:
+        print('invalid priority_weights {0}, using {1}'.format(settings.get('priority_weights'),
+                                                               _default_priority_weights))
+        return _default_priority_weights
+    return weights
+
+
+def _get_poll_order(weights):
+    """
+    returns the priorities in the order to poll their queues: the first is picked at random by weight,
+    so a busy high priority queue cannot starve the others, the rest follow so an empty queue wastes no turn.
+    """
+    priorities = [priority for priority in Priority.all if weights.get(priority, 0) > 0]
+    pick = random.uniform(0, sum(weights[priority] for priority in priorities))
+    for priority in priorities:
+        pick -= weights[priority]
+        if pick <= 0:
+            break
+    return [priority] + [other for other in priorities if other != priority]
+
+
+def _has_fair_share(task, slots, max_builds_per_repo):
+    """
+    returns False if the task's repo already has its share of this worker's build slots.
+    """
+    return sum(1 for slot in slots if slot.task.git_repo == task.git_repo) < max_builds_per_repo
+
+
+def _receive_tasks(task_queues, weights, max_tasks, wait_seconds):
+    """
+    returns up to max_tasks (task, message) from the first priority queue that has any, see _get_poll_order().
+    the long poll wait is shared between the queues.
+    """
+    order = _get_poll_order(weights)
+    wait_per_queue = max(1, wait_seconds // len(order))
+    for priority in order:
+        messages = queues.receive_tasks(task_queues[priority], max_tasks, wait_per_queue)
+        if messages:
+            return [(Task.from_json(message.body), message) for message in messages]
+    return []
+
+
+def _admit_task(task, message):
+    """
+    returns True if the queued task is to be built now.
+    a task superseded or canceled while it was queued is dropped. a task already building whose message came
+    back and whose worker has stopped beating for it was left unfinished, it is built again from its last checkpoint.
+    """
+    state = db.load_task_state(task)
+    if state == State.pending:
+        return True
+
+    if state in _building_states and queues.get_receive_count(message) > 1:
+        task = db.reload_task(task)
+        if not _is_abandoned(task):
+            # its worker is alive, look again later in case it dies without finishing.
+            print('task is still being built by {0}: {1} {2} {3}'.format(
+                task.builder_hostname, task.git_repo, task.git_branch, task.git_tag))
+            queues.change_visibility([message], _abandoned_after)
+            return False
+
+        task.set_state(State.pending, 'the worker building it while {0} stopped, building it again'.format(state))
+        try:
+            db.save_task_state(task)
+            return True
+        except BobTaskConflictError:
+            return False
+
+    print('skipping {0} task: {1} {2} {3}'.format(state, task.git_repo, task.git_branch, task.git_tag))
+    _delete_message(message)
+    return False
+
+
+def _start_parked(parked, slots, settings, build_slots, max_builds_per_repo, fair_share_delay=30):
+    """
+    starts the parked tasks there is a build slot and headroom for, returns the ones still parked.
+    a task whose repo has its share of the build slots is put back for later, or for another worker.
+    """
+    still_parked = []
+    for task, message in parked:
+        if len(slots) >= build_slots or not _has_headroom(settings, len(slots)):
+            still_parked.append((task, message))
+            continue
+
+        if not _has_fair_share(task, slots, max_builds_per_repo):
+            queues.change_visibility([message], fair_share_delay)
+            continue
+
+        if _admit_task(task, message):
+            slots.append(_start_build(task, message))
+    return still_parked
+
+
 def run():
     db.create_task_table()
+    db.create_build_cache_table()
     queues.create_task_queue()
 
+    settings = load_settings()
+    build_slots = int(settings.get('build_slots', 1))
+    weights = _get_priority_weights(settings)
+    max_builds_per_repo = int(settings.get('max_builds_per_repo', max(1, (build_slots + 1) // 2)))
+    long_poll_seconds = int(settings.get('long_poll_seconds', 20))
+
+    # nothing is building yet, so anything left over is from a previous run of the worker.
+    print('removing all docker containers')
+    remove_all_docker_containers()
     print('removing all docker networks')
     remove_all_docker_networks()
-    print('removing all docker images')
-    remove_all_docker_images()
+    _evict_docker_images_blocking(settings)
 
-    task_queue = queues.get_task_queue()
+    task_queues = queues.get_task_queues()
 
+    slots = []
+    # received tasks waiting for a build slot or headroom, their messages are kept hidden meanwhile.
+    parked = []
+    heartbeat = _Heartbeat()
+    heartbeat.start()
     terminate = False
     while not terminate:
+        try:
+            running_builds = len(slots)
+            slots = _check_slots(slots)
 
-        messages = task_queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=1)
-        if not messages or len(messages) == 0:
-            continue
-
-        task = Task.from_json(messages[0].body)
-        if not task:
-            continue
-
-        # clean up old dockers sitting here before.
-        _remove_all_docker_networks_blocking()
-        _remove_all_docker_images_blocking()
-
-        process = Process(target=_run_build, args=(
-            task.git_repo,
-            task.git_branch,
-            task.git_tag,
-            task.created_at,))
+            # a build finished, make room on the disk if its images pushed it over the high water mark.
+            if len(slots) < running_builds:
+                _evict_docker_images_blocking(settings)
 
-        try:
-            process.start()
+            heartbeat.update(slots, parked)
 
-            # delete message for queue now we are actually processing it.
-            messages[0].delete()
+            parked = _start_parked(parked, slots, settings, build_slots, max_builds_per_repo)
+            heartbeat.update(slots, parked)
 
-            while process.is_alive():
-                process.join(2)
+            free_slots = build_slots - len(slots) - len(parked)
+            if free_slots <= 0:
+                sleep(1)
+                continue
 
-                if process.is_alive():
-                    task = db.reload_task(task)
-                    if task.state == State.cancel:
-                        _cancel_task(task, process)
+            # an idle worker waits on the queues, a busy one comes back to check its builds.
+            wait_seconds = long_poll_seconds if not slots and not parked else 1
+            parked += _receive_tasks(task_queues, weights, free_slots, wait_seconds)
+            heartbeat.update(slots, parked)
 
         except KeyboardInterrupt:
             terminate = True
 
-        if process and process.is_alive():
-            _cancel_task(db.reload_task(task), process)
+    heartbeat.stop()
+
+    # let another worker have the tasks this one had not started.
+    if parked:
+        queues.change_visibility([message for _, message in parked], 0)
 
-        _remove_all_docker_networks_blocking()
-        _remove_all_docker_images_blocking()
+    for slot in slots:
+        if slot.process.is_alive():
+            _cancel_task(db.reload_task(slot.task), slot.process)
+        _delete_message(slot.message)
 
+    _remove_all_docker_networks_blocking()
 
 
 def main():
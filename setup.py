@@ -19,6 +19,7 @@ setup(
     install_requires=['boto3', 'pyyaml'],
 
     entry_points={
-        'console_scripts': ['bob=bob.cli.cli:main'],
+        'console_scripts': ['bob=bob.cli.cli:main',
+                            'bob-web=bob.webserver.run:main'],
     }
 )
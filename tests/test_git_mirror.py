@@ -0,0 +1,75 @@
+import os
+import subprocess
+
+import pytest
+
+from bob.common.exceptions import BobTheBuilderException
+from bob.worker.git_mirror import GitMirrorCache
+
+
+def _git(repo_path, *args):
+    return subprocess.check_output(['git', '-C', repo_path] + list(args),
+                                   env=dict(os.environ,
+                                            GIT_AUTHOR_NAME='bob', GIT_AUTHOR_EMAIL='bob@example.com',
+                                            GIT_COMMITTER_NAME='bob', GIT_COMMITTER_EMAIL='bob@example.com')
+                                   ).decode('utf-8').strip()
+
+
+def _commit(repo_path, filename, text):
+    with open(os.path.join(repo_path, filename), 'w') as f:
+        f.write(text)
+    _git(repo_path, 'add', filename)
+    _git(repo_path, 'commit', '--quiet', '-m', text)
+    return _git(repo_path, 'rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def origin(tmp_path):
+    repo_path = str(tmp_path / 'origin')
+    os.mkdir(repo_path)
+    _git(repo_path, 'init', '--quiet', '-b', 'master')
+    return repo_path
+
+
+def _read(path, filename):
+    with open(os.path.join(path, filename), 'r') as f:
+        return f.read()
+
+
+def test_checkout_branch_tag_and_sha(origin, tmp_path):
+    first = _commit(origin, 'version.txt', 'one')
+    _git(origin, 'tag', 'v1')
+    second = _commit(origin, 'version.txt', 'two')
+    url = 'file://' + origin
+    cache = GitMirrorCache(str(tmp_path / 'mirrors'), 1024 ** 3)
+
+    dest = str(tmp_path / 'branch')
+    assert cache.checkout('metocean/example', url, 'refs/heads/master', dest) == second
+    assert _read(dest, 'version.txt') == 'two'
+
+    dest = str(tmp_path / 'tag')
+    assert cache.checkout('metocean/example', url, 'refs/tags/v1', dest) == first
+    assert _read(dest, 'version.txt') == 'one'
+
+    dest = str(tmp_path / 'sha')
+    assert cache.checkout('metocean/example', url, first, dest) == first
+    assert _read(dest, 'version.txt') == 'one'
+
+
+def test_checkout_fetches_new_commits(origin, tmp_path):
+    _commit(origin, 'version.txt', 'one')
+    url = 'file://' + origin
+    cache = GitMirrorCache(str(tmp_path / 'mirrors'), 1024 ** 3)
+    cache.checkout('metocean/example', url, 'refs/heads/master', str(tmp_path / 'first'))
+
+    second = _commit(origin, 'version.txt', 'two')
+    dest = str(tmp_path / 'second')
+    assert cache.checkout('metocean/example', url, 'refs/heads/master', dest) == second
+    assert _read(dest, 'version.txt') == 'two'
+
+
+def test_checkout_unknown_ref(origin, tmp_path):
+    _commit(origin, 'version.txt', 'one')
+    cache = GitMirrorCache(str(tmp_path / 'mirrors'), 1024 ** 3)
+    with pytest.raises(BobTheBuilderException):
+        cache.checkout('metocean/example', 'file://' + origin, 'refs/heads/missing', str(tmp_path / 'dest'))
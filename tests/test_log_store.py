@@ -0,0 +1,34 @@
+from bob.common.log_store import FileLogStore
+
+
+def test_append_and_read(tmp_path):
+    store = FileLogStore(str(tmp_path))
+    chunks = store.append('metocean/example/master/latest/1/build.log', 0, b'first\n')
+    chunks = store.append('metocean/example/master/latest/1/build.log', chunks, b'second\n')
+
+    assert chunks == 2
+    assert store.read('metocean/example/master/latest/1/build.log', chunks) == b'first\nsecond\n'
+
+
+def test_read_only_the_chunks_given(tmp_path):
+    store = FileLogStore(str(tmp_path))
+    chunks = store.append('build.log', 0, b'first\n')
+    store.append('build.log', chunks, b'second\n')
+
+    assert store.read('build.log', chunks) == b'first\n'
+
+
+def test_missing_chunks_read_empty(tmp_path):
+    store = FileLogStore(str(tmp_path))
+    assert store.read('build.log', 2) == b''
+    assert store.tail('build.log', 2) == b''
+
+
+def test_tail_spans_chunks(tmp_path):
+    store = FileLogStore(str(tmp_path))
+    chunks = 0
+    for data in (b'aaaa', b'bbbb', b'cccc'):
+        chunks = store.append('build.log', chunks, data)
+
+    assert store.tail('build.log', chunks, max_bytes=6) == b'bbcccc'
+    assert store.tail('build.log', chunks, max_bytes=100) == b'aaaabbbbcccc'
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import bob.worker.builder as builder
+from bob.common.log_store import FileLogStore, get_log_key
+from bob.common.task import Task
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = FileLogStore(str(tmp_path / 'store'))
+    monkeypatch.setattr(builder, 'get_log_store', lambda: store)
+    monkeypatch.setattr(builder.db, 'save_task_log', lambda task, index: None)
+    return store
+
+
+def _stored(store, task, log_path):
+    entry = task.get_log(os.path.basename(log_path))
+    return store.read(get_log_key(task, entry['filename']), entry['chunks'])
+
+
+def test_appended_log_file(store, tmp_path):
+    task = Task('metocean/example')
+    log_path = str(tmp_path / 'retries.log')
+
+    builder._append_log_file_and_db('first', log_path, task)
+    builder._append_log_file_and_db('second', log_path, task)
+
+    assert _stored(store, task, log_path) == b'first\nsecond\n'
+    assert task.get_log('retries.log')['size'] == len(b'first\nsecond\n')
+
+
+@pytest.mark.parametrize('second', ['same', 'longer text', 'x'])
+def test_rewritten_log_file(store, tmp_path, second):
+    task = Task('metocean/example')
+    log_path = str(tmp_path / 'image-matching.log')
+
+    builder._write_log_file_and_db('abcd', log_path, task)
+    builder._write_log_file_and_db(second, log_path, task)
+
+    assert _stored(store, task, log_path) == second.encode('utf-8')
+    assert task.get_log('image-matching.log')['size'] == len(second)
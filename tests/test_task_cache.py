@@ -0,0 +1,42 @@
+from bob.common.cache import LocalCache, TaskCache
+from bob.common.task import Task, State
+
+
+class _SharedCache(LocalCache):
+    shared = True
+
+
+def _failed_task():
+    task = Task('metocean/example')
+    task.set_state(State.failed, 'build failed')
+    return task
+
+
+def _ttl(backend, key):
+    return backend.entries[key][1] - backend.entries['now'][1]
+
+
+def test_local_cache_keeps_finished_tasks_for_active_ttl():
+    backend = LocalCache()
+    cache = TaskCache(backend, active_ttl=2, done_ttl=3600)
+    cache.set('task', _failed_task())
+    backend.set('now', '', 0)
+    assert _ttl(backend, 'task') <= 2
+
+
+def test_shared_cache_keeps_finished_tasks_for_done_ttl():
+    backend = _SharedCache()
+    cache = TaskCache(backend, active_ttl=2, done_ttl=3600)
+    cache.set('task', _failed_task())
+    backend.set('now', '', 0)
+    assert _ttl(backend, 'task') > 3000
+
+
+def test_shared_cache_keeps_a_just_invalidated_task_for_active_ttl():
+    backend = _SharedCache()
+    cache = TaskCache(backend, active_ttl=2, done_ttl=3600)
+    cache.delete('task')
+    cache.set('task', _failed_task())
+    backend.set('now', '', 0)
+    assert _ttl(backend, 'task') <= 2
+    assert cache.get('task')['state'] == State.failed
@@ -0,0 +1,92 @@
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest.importorskip('pycurl')
+
+from bob.worker.tools import url_download_extract
+
+
+def _tarball():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, content in (('owner-repo-sha/README.md', b'hello\n'),
+                              ('owner-repo-sha/src/main.py', b'print("hi")\n')):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def _zipball():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('owner-repo-sha/README.md', b'hello\n')
+        archive.writestr('owner-repo-sha/src/main.py', b'print("hi")\n')
+    return buffer.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    archives = {'/archive.tar.gz': _tarball(), '/archive.zip': _zipball()}
+
+    def do_GET(self):
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect'):])
+            body = b'moved'
+        elif self.path in self.archives:
+            self.send_response(200)
+            body = self.archives[self.path]
+        else:
+            self.send_response(404)
+            body = b'not found'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def _assert_extracted(dest):
+    with open(os.path.join(dest, 'README.md'), 'rb') as f:
+        assert f.read() == b'hello\n'
+    with open(os.path.join(dest, 'src', 'main.py'), 'rb') as f:
+        assert f.read() == b'print("hi")\n'
+
+
+@pytest.mark.parametrize('path, archive_format', [('/archive.tar.gz', 'tar'), ('/archive.zip', 'zip')])
+def test_download_extract(server_url, tmp_path, path, archive_format):
+    dest = str(tmp_path / 'src')
+    assert url_download_extract(server_url + path, dest, archive_format=archive_format) == 200
+    _assert_extracted(dest)
+
+
+@pytest.mark.parametrize('path, archive_format', [('/archive.tar.gz', 'tar'), ('/archive.zip', 'zip')])
+def test_download_extract_follows_redirect(server_url, tmp_path, path, archive_format):
+    dest = str(tmp_path / 'src')
+    assert url_download_extract(server_url + '/redirect' + path, dest, archive_format=archive_format) == 200
+    _assert_extracted(dest)
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'zip'])
+def test_download_extract_not_found(server_url, tmp_path, archive_format):
+    dest = str(tmp_path / 'src')
+    assert url_download_extract(server_url + '/missing', dest, archive_format=archive_format) == 404
+    assert os.listdir(dest) == []